@@ -0,0 +1,91 @@
+"""
+Compares `CommandIndex.match` with `parse_command` on a generated message corpus.
+
+    python -m bench.bench_command_index [--messages 20000] [--corpus events.jsonl]
+
+Fails if any message resolves differently, then prints the time per event of both.
+"""
+import argparse
+import json
+import random
+import time
+from typing import List
+
+from src.command_index import CommandIndex
+from src.recorder import open_recording
+from src.webhook import parse_command
+
+COMMANDS = ["@all", "@everyone", "@admin", "@admins", "@control", "@info", "@poll"]
+WORDS = ["hello", "there", "what's", "up?", "ok!!", "meeting", "at", "5pm", "(today)", "...", "yes,", "no."]
+
+
+def generate_corpus(n: int, seed: int = 7) -> List[str]:
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(n):
+        tokens = []
+        for _ in range(rng.randint(0, 2)):
+            tokens.append(rng.choice([f"@{rng.randint(10**9, 10**12)}", f"@{rng.randint(10**9, 10**12)}@lid", "@bot"]))
+        if rng.random() < 0.3:
+            tokens.append(rng.choice(COMMANDS) + rng.choice(["", "", "!", ","]))
+        tokens += [rng.choice(WORDS) for _ in range(rng.randint(0, 40))]
+        if rng.random() < 0.2:
+            tokens.insert(rng.randint(0, len(tokens)), f"@{rng.randint(10**9, 10**12)}@lid")
+        texts.append(" ".join(tokens))
+    return texts
+
+
+def load_corpus(path: str) -> List[str]:
+    texts = []
+    for line in open_recording(path):
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        event = record["event"] if isinstance(record.get("event"), dict) else record  # recordings wrap the raw event
+        body = (event.get("payload") or {}).get("body") if isinstance(event, dict) else None
+        if body:
+            texts.append(body)
+    return texts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--corpus", help="JSONL file of WAHA events to take message bodies from")
+    args = parser.parse_args()
+
+    texts = load_corpus(args.corpus) if args.corpus else generate_corpus(args.messages)
+
+    index = CommandIndex()
+    handlers = {}
+    for command in COMMANDS:
+        handlers[command] = object()
+        index.add(command, handlers[command])
+
+    for text in texts:
+        cmd, cmd_args, mentions = parse_command(text)
+        match = index.match(text)
+        expected = (cmd, cmd_args, mentions, handlers.get(cmd.lower()))
+        got = (match.cmd, match.args, match.mentions, match.handler)
+        if expected != got:
+            raise SystemExit(f"Mismatch for {text!r}: {expected} != {got}")
+
+    start = time.perf_counter()
+    for text in texts:
+        cmd, _, _ = parse_command(text)
+        handlers.get(cmd.lower())
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for text in texts:
+        index.match(text).handler
+    indexed = time.perf_counter() - start
+
+    print(f"{len(texts)} messages, identical results")
+    print(f"parse_command:      {legacy / len(texts) * 1e6:8.2f} us/event")
+    print(f"CommandIndex.match: {indexed / len(texts) * 1e6:8.2f} us/event ({legacy / indexed:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Compares one webhook process with the multi-process launcher on the same events.
+
+    python -m bench.bench_launcher [--workers 1,4] [--scenario mixed] [--events 5000] [--replay recording.jsonl]
+        [--concurrency 50] [--waha-latency 0.005] [--members 1000]
+
+For every worker count it starts `bench.fake_waha` and the real `main.py` (with `LAUNCHER_WORKERS`
+set to that count) as separate processes, waits for `/healthcheck` and posts the events over HTTP.
+Rate limits are off and typing takes no time, so a run measures event handling. Reports
+events/sec and p50/p95/p99 webhook latency per worker count. Every process shares the machine's
+cores with the load generator and the fake WAHA, on one core the launcher is slower (see README).
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+from bench.bench_webhook import generate_events, load_events, percentile
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_ready(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def start_waha(args: argparse.Namespace, port: int) -> subprocess.Popen:
+    factory = f"create_fake_waha(latency={args.waha_latency}, members={args.members})"
+    code = f"import uvicorn; from bench.fake_waha import create_fake_waha; uvicorn.run({factory}, port={port}, log_level='warning')"
+    return subprocess.Popen([sys.executable, "-c", code])
+
+
+def start_bot(args: argparse.Namespace, workers: int, port: int, waha_port: int) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "BOT_URL": f"http://127.0.0.1:{waha_port}",
+        "BOT_API_KEY": "bench",
+        "WEBHOOK_PORT": str(port),
+        "LAUNCHER_WORKERS": str(workers),
+        "LOG_LEVEL": args.log_level,
+        "SEND_RATE_GLOBAL": "0",
+        "SEND_RATE_SESSION": "0",
+        "SEND_RATE_CHAT": "0",
+        "TYPING_MIN_SECONDS": "0",
+        "TYPING_MAX_SECONDS": "0",
+        "SEEN_WINDOW": "0.05",
+    }
+    return subprocess.Popen([sys.executable, "main.py"], env=env)
+
+
+def stop(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def run(args: argparse.Namespace, workers: int, bodies: List[bytes]) -> Dict[str, Any]:
+    waha_port, port = free_port(), free_port()
+    waha = start_waha(args, waha_port)
+    bot = None
+    try:
+        await wait_ready(f"http://127.0.0.1:{waha_port}/docs")
+        bot = start_bot(args, workers, port, waha_port)
+        await wait_ready(f"http://127.0.0.1:{port}/healthcheck")
+
+        latencies: List[float] = []
+        statuses: Dict[int, int] = {}
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=None) as client:
+            await client.post("/", content=bodies[0], headers={"Content-Type": "application/json"})
+            queue = iter(bodies)
+
+            async def sender():
+                for body in queue:
+                    start = time.perf_counter()
+                    response = await client.post("/", content=body, headers={"Content-Type": "application/json"})
+                    latencies.append(time.perf_counter() - start)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*(sender() for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - start
+    finally:
+        if bot is not None:
+            stop(bot)
+        stop(waha)
+
+    return {
+        "workers": workers,
+        "events_per_sec": round(len(bodies) / elapsed, 1),
+        "latency_ms": {q: round(percentile(latencies, p) * 1000, 2) for q, p in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "statuses": statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,4", help="comma separated worker counts to compare")
+    parser.add_argument("--scenario", default="mixed", choices=["text_flood", "mention_all", "sticker_storm", "mixed"])
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--replay", help="JSONL file of recorded WAHA events to replay instead of a generated scenario")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--waha-latency", type=float, default=0.005)
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    events = load_events(args.replay) if args.replay else generate_events(args.scenario, args.events)
+    if not events:
+        raise SystemExit("No events to replay")
+    bodies = [json.dumps(e).encode() for e in events]
+
+    results = [asyncio.run(run(args, int(n), bodies)) for n in args.workers.split(",")]
+    print(json.dumps({"scenario": args.replay or args.scenario, "events": len(bodies), "runs": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
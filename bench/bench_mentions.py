@@ -0,0 +1,116 @@
+"""
+Compares `MentionEngine`/`MentionScan` with the per-call helpers they replaced.
+
+    python -m bench.bench_mentions [--messages 5000] [--mentions 50] [--members 1000]
+
+Generates long messages with many mentions (full ids like the ones @all sends, bare `@<digits>`
+like received ones, some of the bot) and fails if any message resolves differently. Then prints
+the time per message of "mentions me", "mentioned ids" and "strip for sending" done separately
+the old way and from one scan, and of filtering the bot out of a group's members.
+"""
+import argparse
+import random
+import re
+import time
+from typing import Any, Dict, List
+
+from bench.fake_waha import make_members
+from src.mentions import DOMAINS_RE, MentionEngine, MentionScan, cleanup_label
+
+ME = {"id": "19990000000@c.us", "jid": "19990000000@s.whatsapp.net", "lid": "99990000000000:12@lid"}
+WORDS = ["hello", "there", "what's", "up?", "ok!!", "meeting", "at", "5pm", "(today)", "...", "yes,", "no.", "a@b"]
+
+# The helpers as they were before src/mentions.py
+MENTIONS_RE = re.compile(rf"@(\d+)@({DOMAINS_RE})")
+MENTIONS_RECV_RE = re.compile(r"@(\d+)")
+
+
+def legacy_parse_mentions_for_sending(text):
+    matches = MENTIONS_RE.findall(text)
+    mentions = list(set([f"{m[0]}@{m[1]}" for m in matches]))
+    return MENTIONS_RE.sub(r"@\1", text), mentions
+
+
+def legacy_get_mentions(text):
+    return list(set(MENTIONS_RECV_RE.findall(text)))
+
+
+def legacy_is_mentioned(text, user):
+    suffixes = ("@c.us", "@lid", "@s.whatsapp.net")
+    mentions = {m + s for m in legacy_get_mentions(text) for s in suffixes}
+    return any(u and u in mentions for u in (user.get("id"), user.get("jid"), cleanup_label(user.get("lid"))))
+
+
+def legacy_is_me(target_id, me):
+    return target_id in (me.get("id", ""), me.get("lid", ""), me.get("jid", ""))
+
+
+def generate_messages(n: int, mentions: int, seed: int = 7) -> List[str]:
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(n):
+        tokens = [rng.choice(WORDS) for _ in range(rng.randint(5, 40))]
+        for _ in range(rng.randint(mentions // 2, mentions)):
+            number = str(rng.randint(10**9, 10**12))
+            tokens.append(rng.choice([f"@{number}", f"@{number}@c.us", f"@{number}@lid", f"@{number}@s.whatsapp.net"]))
+        if rng.random() < 0.3:
+            tokens.append(rng.choice(["@19990000000", "@99990000000000", "@19990000000@c.us"]))
+        rng.shuffle(tokens)
+        texts.append(" ".join(tokens))
+    return texts
+
+
+def timed(fn, items) -> float:
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return (time.perf_counter() - start) / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--mentions", type=int, default=50, help="most mentions per message")
+    parser.add_argument("--members", type=int, default=1000)
+    args = parser.parse_args()
+
+    texts = generate_messages(args.messages, args.mentions)
+    me_parsed = {**ME, "lid": cleanup_label(ME["lid"])}  # what handlers get as parsed["me"]
+    engine = MentionEngine.for_me(ME)
+
+    for text in texts:
+        scan = MentionScan(text)
+        old_text, old_mentions = legacy_parse_mentions_for_sending(text)
+        expected = (legacy_is_mentioned(text, ME), set(legacy_get_mentions(text)), old_text, set(old_mentions))
+        got = (engine.mentions_me(scan), scan.ids, scan.text, set(scan.mentions))
+        if expected != got:
+            raise SystemExit(f"Mismatch for {text!r}: {expected} != {got}")
+
+    def legacy(text: str):
+        legacy_is_mentioned(text, ME)
+        legacy_get_mentions(text)
+        legacy_parse_mentions_for_sending(text)
+
+    def scanned(text: str):
+        scan = MentionScan(text)
+        engine.mentions_me(scan)
+        scan.for_sending()
+
+    members: List[Dict[str, Any]] = make_members(args.members)
+    members.insert(args.members // 2, {"id": ME["id"], "lid": me_parsed["lid"], "admin": None})
+    targets = [m.get("lid") or m.get("id") for m in members] * 100  # long enough to time per member
+
+    legacy_text = timed(legacy, texts)
+    engine_text = timed(scanned, texts)
+    legacy_members = timed(lambda t: legacy_is_me(t, me_parsed), targets)
+    engine_members = timed(engine.is_me, targets)
+
+    print(f"{len(texts)} messages with up to {args.mentions} mentions, identical results")
+    print(f"legacy helpers: {legacy_text:8.2f} us/message")
+    print(f"one scan:       {engine_text:8.2f} us/message ({legacy_text / engine_text:.1f}x)")
+    print(f"is_me:          {legacy_members * 1000:8.2f} ns/member")
+    print(f"engine.is_me:   {engine_members * 1000:8.2f} ns/member ({legacy_members / engine_members:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Replays WAHA webhook events against `bot.app` in-process and reports throughput.
+
+    python -m bench.bench_webhook [--scenario text_flood|mention_all|sticker_storm|mixed] [--events 5000]
+        [--replay recording.jsonl] [--concurrency 50] [--dispatch inline|queue]
+        [--waha-latency 0.005] [--members 1000] [--typing-scale 0.001] [--rate-limits] [--trace-memory] [--log-level WARNING]
+
+Events go through httpx's ASGI transport, the bot's WAHA client talks to `bench.fake_waha`.
+Typing delays are multiplied by `--typing-scale` and the outbound rate limiter is off unless
+`--rate-limits` is given, so a run measures the bot rather than the simulated human.
+Reports events/sec, p50/p95/p99 webhook latency, WAHA calls and memory growth.
+"""
+import argparse
+import asyncio
+import json
+import random
+import resource
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from bench.fake_waha import create_fake_waha
+from src.custom_client import WAHABot
+from src.dispatch import EventDispatcher
+from src.log import setup_logging, shutdown_logging
+from src.ratelimit import OutboundLimiter
+from src.recorder import open_recording
+from src.utils import get_mentions_list
+from src.webhook import webhook
+
+ME = {"id": "19990000000@c.us", "jid": "19990000000@s.whatsapp.net", "lid": "99990000000000@lid", "pushName": "bot"}
+GROUP = "120363000000000000@g.us"
+STICKER_HASH = "bench-sticker-hash"
+WORDS = ["hello", "there", "what's", "up?", "ok!!", "meeting", "at", "5pm", "(today)", "...", "yes,", "no."]
+
+
+def message_event(n: int, chat_id: str, body: str, sender: int, sticker: bool = False) -> Dict[str, Any]:
+    is_group = chat_id.endswith("@g.us")
+    key = {"participantPn": f"{sender}@s.whatsapp.net"} if is_group else {"senderLid": f"{sender}@lid"}
+    data: Dict[str, Any] = {"key": key, "message": {}}
+    if sticker:
+        data["message"]["stickerMessage"] = {"fileSha256": STICKER_HASH, "mediaKey": f"key-{n}"}
+    return {
+        "event": "message",
+        "session": "default",
+        "me": ME,
+        "payload": {
+            "id": f"false_{chat_id}_BENCH{n:08d}",
+            "from": chat_id,
+            "to": chat_id if is_group else ME["id"],
+            "fromMe": False,
+            "participant": f"{sender}@lid" if is_group else None,
+            "body": body,
+            "_data": data,
+        },
+    }
+
+
+def generate_events(scenario: str, n: int, seed: int = 7) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    events = []
+    for i in range(n):
+        kind = scenario if scenario != "mixed" else rng.choice(["text_flood"] * 8 + ["mention_all", "sticker_storm"])
+        sender = 10**10 + rng.randint(0, 5000)
+        if kind == "mention_all":
+            events.append(message_event(i, GROUP, "@all " + " ".join(rng.choices(WORDS, k=5)), sender))
+        elif kind == "sticker_storm":
+            chat_id = GROUP if rng.random() < 0.5 else f"{sender}@c.us"
+            events.append(message_event(i, chat_id, "", sender, sticker=True))
+        else:
+            chat_id = f"{10**10 + rng.randint(0, 200)}@c.us" if rng.random() < 0.7 else GROUP
+            body = "@info" if rng.random() < 0.1 else " ".join(rng.choices(WORDS, k=rng.randint(1, 30)))
+            events.append(message_event(i, chat_id, body, sender))
+    return events
+
+
+def load_events(path: str) -> List[Dict[str, Any]]:
+    events = []
+    for line in open_recording(path):
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        # Recordings wrap the raw event as {"ts": ..., "event": {...}}
+        event = record["event"] if isinstance(record.get("event"), dict) else record
+        if isinstance(event, dict) and event.get("event"):
+            events.append(event)
+    return events
+
+
+def build_bot(args: argparse.Namespace, waha: Any) -> WAHABot:
+    dispatcher = EventDispatcher(concurrency=args.workers, max_queue=max(1000, args.events)) if args.dispatch == "queue" else None
+    limiter = None if args.rate_limits else OutboundLimiter(global_rate=0, session_rate=0, chat_rate=0)
+    bot = WAHABot(base_url="http://waha", api_key="bench", session="default", webhook_func=webhook,
+        dispatcher=dispatcher, limiter=limiter, seen_window=0.05)
+    bot.http = httpx.AsyncClient(base_url="http://waha", transport=httpx.ASGITransport(app=waha),
+        headers=bot.http.headers, event_hooks=bot.http.event_hooks)
+
+    estimate = bot._estimate_typing_seconds
+    bot._estimate_typing_seconds = lambda text, mentions=[]: estimate(text, mentions) * args.typing_scale
+
+    @bot.on("@info")
+    async def on_info(client: WAHABot, chat_id: str, message_id: str, parsed, args, **kwargs):
+        return client.send_later(chat_id, f"*User ID:* {parsed.get('sender')}\n*Chat ID:* {chat_id}", message_id)
+
+    @bot.on("@all", "@everyone")
+    async def on_all(client: WAHABot, chat_id: str, message_id: str, parsed, args, **kwargs):
+        mentions = await get_mentions_list(client, chat_id, parsed.get("me", {}), admins_only=False)
+        return client.send_later(chat_id, " ".join(args) + "\n" + " | ".join(mentions), message_id)
+
+    @bot.on_sticker(STICKER_HASH)
+    async def on_sticker(client: WAHABot, chat_id: str, message_id: str, *a, **kwargs):
+        return client.send_later(chat_id, "nice sticker", message_id)
+
+    return bot
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # peak, Linux reports KiB
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def replay(args: argparse.Namespace, events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    waha = create_fake_waha(latency=args.waha_latency, jitter=args.waha_jitter, members=args.members)
+    bot = build_bot(args, waha)
+    bodies = [json.dumps(e).encode() for e in events]
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+
+    async with bot.app.router.lifespan_context(bot.app):
+        transport = httpx.ASGITransport(app=bot.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bot", timeout=None) as client:
+            # Warm up imports, caches and the connection pool outside the measurement
+            await client.post("/", content=bodies[0], headers={"Content-Type": "application/json"})
+
+            if args.trace_memory:
+                tracemalloc.start()
+            rss_before = rss_mb()
+            queue = iter(bodies)
+
+            async def worker():
+                for body in queue:
+                    start = time.perf_counter()
+                    response = await client.post("/", content=body, headers={"Content-Type": "application/json"})
+                    latencies.append(time.perf_counter() - start)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+            accepted = time.perf_counter() - start
+        # Leaving the lifespan drains the dispatcher and flushes pending sends and receipts
+    total = time.perf_counter() - start
+
+    traced: Optional[Dict[str, float]] = None
+    if args.trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        traced = {"current_mb": round(current / 2**20, 2), "peak_mb": round(peak / 2**20, 2)}
+
+    return {
+        "events": len(bodies),
+        "accepted_per_sec": round(len(bodies) / accepted, 1),
+        "events_per_sec": round(len(bodies) / total, 1),
+        "latency_ms": {q: round(percentile(latencies, p) * 1000, 2) for q, p in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "statuses": statuses,
+        "waha_calls": dict(waha.state.calls),
+        "rss_growth_mb": round(rss_mb() - rss_before, 2),
+        "traced_memory": traced,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", default="text_flood", choices=["text_flood", "mention_all", "sticker_storm", "mixed"])
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--replay", help="JSONL file of recorded WAHA events to replay instead of a generated scenario")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--dispatch", default="inline", choices=["inline", "queue"])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--waha-latency", type=float, default=0.005)
+    parser.add_argument("--waha-jitter", type=float, default=0.0)
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--typing-scale", type=float, default=0.001)
+    parser.add_argument("--rate-limits", action="store_true", help="keep the default outbound rate limits")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--trace-memory", action="store_true", help="also report tracemalloc numbers (slower)")
+    args = parser.parse_args()
+
+    events = load_events(args.replay) if args.replay else generate_events(args.scenario, args.events)
+    if not events:
+        raise SystemExit("No events to replay")
+    args.events = len(events)
+
+    setup_logging(level=args.log_level)
+    try:
+        result = asyncio.run(replay(args, events))
+    finally:
+        shutdown_logging()
+    print(json.dumps({"scenario": args.replay or args.scenario, "dispatch": args.dispatch, **result}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+In-process stand-in for the WAHA API used by the benchmarks.
+
+Answers the calls the bot makes (`/api/sendText`, `/api/sendSeen`, `/api/sendPoll`, presence,
+group participants, message deletion) after `latency` seconds and counts them per route.
+"""
+import asyncio
+from collections import Counter
+import itertools
+import random
+from typing import Any, Dict, List
+
+from fastapi import FastAPI, Request
+
+
+def make_members(count: int, admins: int = 5) -> List[Dict[str, Any]]:
+    members = []
+    for i in range(count):
+        phone = 10**10 + i
+        members.append({
+            "id": f"{phone}@c.us",
+            "jid": f"{phone}@s.whatsapp.net",
+            "lid": f"{2 * 10**13 + i}@lid",
+            "admin": "admin" if i < admins else None,
+        })
+    return members
+
+
+def create_fake_waha(latency: float = 0.0, jitter: float = 0.0, members: int = 1000, seed: int = 7) -> FastAPI:
+    app = FastAPI()
+    app.state.calls = Counter()
+    rng = random.Random(seed)
+    ids = itertools.count(1)
+    group_members = make_members(members)
+
+    async def delay():
+        wait = latency + (rng.uniform(0, jitter) if jitter else 0)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    @app.post("/api/sendText")
+    async def send_text(request: Request):
+        app.state.calls["sendText"] += 1
+        await request.body()
+        await delay()
+        return {"id": f"true_fake_{next(ids)}"}
+
+    @app.post("/api/sendSeen")
+    async def send_seen():
+        app.state.calls["sendSeen"] += 1
+        await delay()
+        return {}
+
+    @app.post("/api/sendPoll")
+    async def send_poll():
+        app.state.calls["sendPoll"] += 1
+        await delay()
+        return {"id": f"true_fake_{next(ids)}"}
+
+    @app.post("/api/{session}/presence")
+    async def presence(session: str):
+        app.state.calls["presence"] += 1
+        await delay()
+        return {}
+
+    @app.get("/api/{session}/groups/{chat_id}/participants")
+    async def participants(session: str, chat_id: str):
+        app.state.calls["participants"] += 1
+        await delay()
+        return group_members
+
+    @app.delete("/api/{session}/chats/{chat_id}/messages/{message_id}")
+    async def delete_message(session: str, chat_id: str, message_id: str):
+        app.state.calls["deleteMessage"] += 1
+        await delay()
+        return {}
+
+    return app
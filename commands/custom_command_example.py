@@ -19,6 +19,7 @@ async def on_mention_poll_create(
         )
         messages.append(" ".join(mentions))
 
+    # Awaited (not `send_later`) because the poll replies to this message
     text_resp = await client.send(chat_id, "\n".join(messages))
     message_resp_id = text_resp.get("key", {}).get("id")
     message_resp_bool = text_resp.get("key", {}).get("fromMe", True)
@@ -4,8 +4,19 @@ from typing import Any, Dict, List, Optional
 
 from fastapi import Request
 from fastapi.responses import JSONResponse
+import httpx
+from src.batch import BatchSender, validate_batch
+from src.launcher import job_prefix
 from src.custom_client import WAHABot
-from src.storage import storage_get_messages
+from src.dedup import EventDeduplicator
+from src.dispatch import EventDispatcher
+from src.log import get_logger, setup_logging, shutdown_logging
+from src.prefilter import loads
+from src.storage import storage_configure, storage_get_messages, storage_get_since_time
+from src.ratelimit import PRIORITY_BULK, OutboundLimiter
+from src.state import state_backend
+from src.recorder import EventRecorder
+from src.transport import CircuitBreaker, RequestPolicy, RetryBudget, RetryPolicy
 from src.webhook import webhook
 from src.utils import get_mentions_list
 
@@ -25,6 +36,24 @@ try:
 except Exception:
     ...
 
+setup_logging(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    sample_rate=float(os.getenv("LOG_SAMPLE_RATE", 1)),
+    queue_size=int(os.getenv("LOG_QUEUE_SIZE", 10000)),
+)
+logger = get_logger("main")
+
+launcher_workers = int(os.getenv("LAUNCHER_WORKERS", 1))
+if __name__ == "__main__" and launcher_workers > 1:
+    # Router only, each worker process imports this module as `main` and builds its own bot
+    from src.launcher import run_launcher
+    try:
+        run_launcher(launcher_workers, port=int(os.getenv("WEBHOOK_PORT", 8000)),
+            socket_dir=os.getenv("LAUNCHER_SOCKET_DIR", "/tmp"), log_level=os.getenv("LOG_LEVEL", "INFO").lower())
+    finally:
+        shutdown_logging()
+    exit(0)
+
 def require_auth(func):
     @wraps(func)
     async def wrapper(request: Request, *args, **kwargs):
@@ -38,16 +67,110 @@ base_url = os.getenv("BOT_URL")
 api_keys = [a.strip() for a in os.getenv("BOT_API_KEY", "").split(",") if a.strip()]
 run_port = os.getenv("WEBHOOK_PORT", 8000)
 notifs_admins = [a.strip() for a in os.getenv("NOTIFS_ADMINS", "").split(",") if a.strip()]
+sessions = [s.strip() for s in os.getenv("WAHA_SESSIONS", "default").split(",") if s.strip()] or ["default"]
 if not base_url or not api_keys or not any(api_keys):
     print("Some Environmental Variables are missing!")
     exit(1)
-bot = WAHABot(base_url=base_url, api_key=api_keys[0], session="default", webhook_func=webhook, notifs_admins=notifs_admins)
+workers = int(os.getenv("UVICORN_WORKERS", 1))
+state_kind = os.getenv("STATE_BACKEND", "memory").strip().lower()
+storage_kind = os.getenv("STORAGE_BACKEND", "memory").strip().lower()
+if workers > 1 and (state_kind != "sqlite" or storage_kind != "sqlite"):
+    print("UVICORN_WORKERS > 1 needs STATE_BACKEND=sqlite and STORAGE_BACKEND=sqlite so workers share state!")
+    exit(1)
+state = state_backend(state_kind, os.getenv("STATE_PATH", "extras/state.sqlite3"))
+storage_configure(storage_kind, os.getenv("STORAGE_PATH", "extras/history.sqlite3"), state=state)
+
+dispatch_mode = os.getenv("WEBHOOK_DISPATCH", "inline").strip().lower()
+if dispatch_mode == "queue":
+    dispatcher = EventDispatcher(
+        concurrency=int(os.getenv("WEBHOOK_WORKERS", 4)),
+        max_queue=int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000)),
+        overflow=os.getenv("WEBHOOK_QUEUE_OVERFLOW", "reject").strip().lower(),
+        drain_timeout=float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", 30)),
+        max_lanes=int(os.getenv("WEBHOOK_MAX_LANES", 1000)),
+    )
+else:
+    dispatcher = None
+record_dir = os.getenv("RECORD_DIR", "").strip()
+recorder = EventRecorder(
+    record_dir,
+    sample_rate=float(os.getenv("RECORD_SAMPLE_RATE", 1)),
+    compression=os.getenv("RECORD_COMPRESSION", "gzip").strip().lower(),
+    redact=os.getenv("RECORD_REDACT", "true").strip().lower() in ("1", "true", "yes"),
+    salt=os.getenv("RECORD_SALT", ""),
+    max_bytes=int(float(os.getenv("RECORD_MAX_MB", 64)) * 2**20),
+    max_age=float(os.getenv("RECORD_MAX_AGE", 3600)),
+    buffer_size=int(os.getenv("RECORD_BUFFER_SIZE", 10000)),
+) if record_dir else None
+dedup_window = float(os.getenv("DEDUP_WINDOW", 300))
+dedup = EventDeduplicator(
+    window=dedup_window,
+    max_entries=int(os.getenv("DEDUP_MAX_ENTRIES", 100000)),
+    state=state,
+) if dedup_window > 0 else None
+bot = WAHABot(base_url=base_url, api_key=api_keys[0], session=sessions[0], webhook_func=webhook, notifs_admins=notifs_admins, dispatcher=dispatcher,
+    wpm=float(os.getenv("TYPING_WPM", 125)),
+    t_min=float(os.getenv("TYPING_MIN_SECONDS", 0.9)),
+    t_max=float(os.getenv("TYPING_MAX_SECONDS", 8)),
+    participants_ttl=float(os.getenv("PARTICIPANTS_CACHE_TTL", 300)),
+    participants_cache_size=int(os.getenv("PARTICIPANTS_CACHE_SIZE", 256)),
+    seen_window=float(os.getenv("SEEN_WINDOW", 2)),
+    seen_batch_size=int(os.getenv("SEEN_BATCH_SIZE", 10)),
+    prefilter=os.getenv("EVENT_PREFILTER", "true").strip().lower() in ("1", "true", "yes"),
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("WAHA_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(os.getenv("WAHA_MAX_KEEPALIVE", 20)),
+        keepalive_expiry=float(os.getenv("WAHA_KEEPALIVE_EXPIRY", 30)),
+    ),
+    http2=os.getenv("WAHA_HTTP2", "false").strip().lower() in ("1", "true", "yes"),
+    request_policy=RequestPolicy(
+        retry=RetryPolicy(
+            attempts=int(os.getenv("WAHA_RETRY_ATTEMPTS", 3)),
+            base_delay=float(os.getenv("WAHA_RETRY_BASE_DELAY", 0.2)),
+            budget=RetryBudget(ratio=float(os.getenv("WAHA_RETRY_BUDGET", 0.2))),
+        ),
+        breaker=CircuitBreaker(
+            threshold=int(os.getenv("WAHA_BREAKER_THRESHOLD", 5)),
+            reset_timeout=float(os.getenv("WAHA_BREAKER_RESET", 10)),
+        ),
+        timeouts={
+            k.strip(): float(v) for k, v in
+            (t.split("=", 1) for t in os.getenv("WAHA_TIMEOUTS", "").split(",") if "=" in t)
+        },
+    ),
+    limiter=OutboundLimiter(
+        global_rate=float(os.getenv("SEND_RATE_GLOBAL", 10)),
+        global_burst=float(os.getenv("SEND_BURST_GLOBAL", 20)),
+        session_rate=float(os.getenv("SEND_RATE_SESSION", 10)),
+        session_burst=float(os.getenv("SEND_BURST_SESSION", 20)),
+        chat_rate=float(os.getenv("SEND_RATE_CHAT", 1)),
+        chat_burst=float(os.getenv("SEND_BURST_CHAT", 5)),
+        max_queue=int(os.getenv("SEND_QUEUE_SIZE", 1000)),
+    ),
+    recorder=recorder,
+    dedup=dedup,
+    state=state,
+)
+app = bot.app
+@bot.on_startup
+async def serve_sessions():
+    for session_name in sessions[1:]:
+        await bot.sessions.add(session_name)
+
+batch_sender = BatchSender(bot,
+    concurrency=int(os.getenv("BATCH_CONCURRENCY", 50)),
+    max_items=int(os.getenv("BATCH_MAX_ITEMS", 1000)),
+    max_jobs=int(os.getenv("BATCH_MAX_JOBS", 100)),
+    # Under the launcher job ids name this worker, status requests are routed back to it
+    job_prefix=job_prefix(int(os.environ["WAHABOT_WORKER"])) if os.getenv("WAHABOT_WORKER") else "",
+)
+bot.on_shutdown(batch_sender.stop)
 
 @bot.on("@info")
 async def on_get_info(client: WAHABot, chat_id: str, message_id: str, parsed, args, **kwargs) -> Dict[str, Any]:
     sender_id = parsed.get("sender")
     sender_label = parsed.get("sender_label")
-    sender_name = kwargs.get("raw", {}).get("payload", {}).get("_data", {}).get("pushName", "Unknown")
+    sender_name = parsed.push_name or "Unknown"
     
     message = f"""
     *User ID:* {sender_id}
@@ -58,12 +181,12 @@ async def on_get_info(client: WAHABot, chat_id: str, message_id: str, parsed, ar
     """.strip()
     message = '\n'.join([a.strip() for a in message.split("\n") if a.strip()])
     
-    return await client.send(chat_id, message, message_id)
+    return client.send_later(chat_id, message, message_id)
     
 
 async def on_mentions_handler(client: WAHABot, chat_id: str, message_id: str, parsed, args, admins_only, **kwargs) -> Dict[str, Any]:
     if not parsed.get("is_group"):
-        print("No tags in private chats")
+        logger.debug("No tags in private chats")
         return {"status": "ok"}
 
     messages = await get_mentions_list(client, chat_id, parsed.get("me", {}), admins_only=admins_only)
@@ -82,7 +205,7 @@ async def on_mentions_handler(client: WAHABot, chat_id: str, message_id: str, pa
     else:
         reply_to = message_id
 
-    return await bot.send(
+    return client.send_later(
         chat_id=chat_id,
         text=text,
         reply_to=reply_to,
@@ -109,10 +232,70 @@ async def send_message(request: Request):
     if not chat_id or not message:
         return JSONResponse({"error": "`chat_id` and `text` are both required and cannot be empty"}, 400)
 
+    client = bot.sessions.get(body.get("session") or bot.session)
+    if client is None:
+        return JSONResponse({"error": f"Unknown session {body.get('session')}"}, 400)
+
     reply_to = body.get("reply_to")
-    resp = await bot.send(chat_id=chat_id, text=message, reply_to=reply_to)
+    resp = await client.send(chat_id=chat_id, text=message, reply_to=reply_to, priority=PRIORITY_BULK)
     return JSONResponse(resp)
 
+@bot.app.post("/send/batch")
+@require_auth
+async def send_batch(request: Request):
+    body = await request.body()
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            items = [loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = loads(body)
+            if isinstance(items, dict):
+                items = items.get("messages")
+    except ValueError as e:
+        return JSONResponse({"error": f"Invalid body: {e}"}, 400)
+
+    messages, errors = validate_batch(items, batch_sender.max_items, bot.sessions.names())
+    if errors:
+        return JSONResponse({"error": "Invalid batch, nothing was sent", "errors": errors}, 400)
+
+    job = batch_sender.submit(messages)
+    return JSONResponse({"job_id": job.id, "count": len(messages)}, 202)
+
+@bot.app.get("/send/batch/{job_id}")
+@require_auth
+async def send_batch_status(request: Request, job_id: str):
+    summary = await batch_sender.status(job_id)
+    if summary is None:
+        return JSONResponse({"error": "Unknown or expired job"}, 404)
+    return JSONResponse(summary)
+
+@bot.app.get("/sessions")
+@require_auth
+async def list_sessions(request: Request):
+    return JSONResponse({"default": bot.session, "sessions": bot.sessions.stats()})
+
+@bot.app.post("/sessions")
+@require_auth
+async def add_session(request: Request):
+    body = await request.json()
+    name = body.get("name") if isinstance(body, dict) else None
+    if not isinstance(name, str) or not name.strip():
+        return JSONResponse({"error": "`name` is required and cannot be empty"}, 400)
+    created = name.strip() not in bot.sessions
+    await bot.sessions.add(name)
+    return JSONResponse({"session": name.strip(), "created": created}, 201 if created else 200)
+
+@bot.app.delete("/sessions/{name}")
+@require_auth
+async def remove_session(request: Request, name: str):
+    try:
+        removed = await bot.sessions.remove(name)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, 400)
+    if not removed:
+        return JSONResponse({"error": "Unknown session"}, 404)
+    return JSONResponse({"session": name, "removed": True})
+
 @bot.app.get("/healthcheck")
 async def healthcheck():
     return {"status": "ok"}
@@ -121,22 +304,35 @@ async def healthcheck():
 @require_auth
 async def pull_messages(request: Request, chat_id: str):
     n = int(request.query_params.get("n", "20"))
-    messages = storage_get_messages(chat_id, n)
+    since = request.query_params.get("since")
+    if since:
+        messages = (await storage_get_since_time(chat_id, float(since)))[-n:]
+    else:
+        messages = await storage_get_messages(chat_id, n)
     return JSONResponse({"chat_id": chat_id, "count": len(messages), "messages": messages})
 
+@bot.app.get("/stats")
+@require_auth
+async def stats(request: Request):
+    return JSONResponse({
+        "participants_cache": bot.participants.stats(),
+        "prefilter": bot.prefilter.stats() if bot.prefilter else None,
+        "dedup": bot.dedup.stats() if bot.dedup else None,
+    })
+
 
-print("Registering Additional Commands")
+logger.info("Registering Additional Commands")
 for listener, commands in custom_commands_registry.items():
     listener_func = getattr(bot, listener)
 
     for cmd_var in commands:
         if isinstance(cmd_var, tuple):
             command_func, *command = cmd_var
-            print(f"Registering {command} on {command_func.__name__} as {listener}")
+            logger.info("Registering %s on %s as %s", command, command_func.__name__, listener)
         else:
             command_func = cmd_var
             command = []
-            print(f"Registering {command_func.__name__} as {listener}")
+            logger.info("Registering %s as %s", command_func.__name__, listener)
         decorated_func = listener_func(*command)(command_func)
         globals()[command_func.__name__] = decorated_func
 
@@ -145,4 +341,11 @@ for custom_router in custom_routers:
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(bot.app, host="0.0.0.0", port=int(run_port))
+    try:
+        if workers > 1:
+            # Every worker process imports this module and builds its own bot on the shared state
+            uvicorn.run("main:app", host="0.0.0.0", port=int(run_port), workers=workers)
+        else:
+            uvicorn.run(bot.app, host="0.0.0.0", port=int(run_port))
+    finally:
+        shutdown_logging()
@@ -0,0 +1,170 @@
+from __future__ import annotations
+import asyncio
+from collections import OrderedDict
+import time
+from typing import TYPE_CHECKING, Any, Container, Dict, List, Optional, Tuple
+import uuid
+
+from src.log import get_logger
+from src.ratelimit import PRIORITY_BULK
+
+if TYPE_CHECKING:
+    from src.custom_client import WAHABot  # only for type checking
+
+logger = get_logger("batch")
+
+
+def validate_batch(items: Any, max_items: int, sessions: Optional[Container[str]] = None,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Returns (messages, errors), nothing is sent unless every item is valid."""
+    if not isinstance(items, list) or not items:
+        return [], [{"index": None, "error": "expected a non-empty list of messages"}]
+    if len(items) > max_items:
+        return [], [{"index": None, "error": f"at most {max_items} messages per batch, got {len(items)}"}]
+
+    messages, errors = [], []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({"index": index, "error": "message must be an object"})
+            continue
+        chat_id, text = item.get("chat_id"), item.get("text")
+        if not isinstance(chat_id, str) or not chat_id.strip() or not isinstance(text, str) or not text.strip():
+            errors.append({"index": index, "error": "`chat_id` and `text` are both required and cannot be empty"})
+            continue
+        reply_to = item.get("reply_to")
+        if reply_to is not None and not isinstance(reply_to, str):
+            errors.append({"index": index, "error": "`reply_to` must be a string"})
+            continue
+        typing = item.get("typing", True)
+        if not isinstance(typing, bool):
+            errors.append({"index": index, "error": "`typing` must be a boolean"})
+            continue
+        session = item.get("session")
+        if session is not None and (not isinstance(session, str) or (sessions is not None and session not in sessions)):
+            errors.append({"index": index, "error": "`session` must be the name of a served session"})
+            continue
+        messages.append({"chat_id": chat_id.strip(), "text": text, "reply_to": reply_to, "typing": typing, "session": session})
+    return messages, errors
+
+
+class BatchJob:
+    def __init__(self, messages: List[Dict[str, Any]], prefix: str = ""):
+        self.id = prefix + uuid.uuid4().hex
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.messages = messages
+        self.results: List[Dict[str, Any]] = [{"status": "pending"} for _ in messages]
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def summary(self, with_items: bool = True) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        for result in self.results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        summary = {
+            "job_id": self.id,
+            "status": "done" if self.done else "running",
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "total": len(self.messages),
+            "counts": counts,
+        }
+        if with_items:
+            summary["items"] = [
+                {"index": i, "chat_id": m["chat_id"], **r} for i, (m, r) in enumerate(zip(self.messages, self.results))
+            ]
+        return summary
+
+
+class BatchSender:
+    """
+    Fans bulk sends out through `WAHABot.send` at bulk priority.
+
+    At most `concurrency` messages of all jobs are in flight, the outbound rate
+    limiter paces them. Finished jobs are kept for their status endpoint until
+    `max_jobs` newer ones pushed them out. With shared state other workers see a job's
+    summary as of its start and its end. `job_prefix` starts every job id, the launcher
+    routes status requests to the worker it names.
+    """
+
+    def __init__(self, bot: "WAHABot", concurrency: int = 50, max_items: int = 1000, max_jobs: int = 100,
+        result_ttl: float = 3600, job_prefix: str = "",
+    ):
+        self.bot = bot
+        self.job_prefix = job_prefix
+        self.result_ttl = result_ttl
+        self.max_items = max_items
+        self.max_jobs = max(1, max_jobs)
+        self.concurrency = max(1, concurrency)
+        self._semaphore: Optional[asyncio.Semaphore] = None  # created on the serving loop
+        self._jobs: "OrderedDict[str, BatchJob]" = OrderedDict()
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        return self._jobs.get(job_id)
+
+    async def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        # Jobs submitted through another worker are known from the summary it shared
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.summary()
+        if self.bot.state.shared:
+            return await self.bot.state.aget("batch", job_id)
+        return None
+
+    async def _share(self, job: BatchJob):
+        if self.bot.state.shared:
+            await self.bot.state.aset("batch", job.id, job.summary(), ttl=self.result_ttl)
+
+    def submit(self, messages: List[Dict[str, Any]]) -> BatchJob:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        job = BatchJob(messages, self.job_prefix)
+        self._jobs[job.id] = job
+        self._evict()
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    def _evict(self):
+        while len(self._jobs) > self.max_jobs:
+            oldest = next((job_id for job_id, job in self._jobs.items() if job.done), None)
+            if oldest is None:
+                return  # only running jobs, keep them
+            del self._jobs[oldest]
+
+    async def _run(self, job: BatchJob):
+        try:
+            await self._share(job)
+            await asyncio.gather(*(self._send_one(job, i) for i in range(len(job.messages))))
+        finally:
+            job.finished_at = time.time()
+            await self._share(job)
+            logger.info("Batch %s finished: %s", job.id, job.summary(with_items=False)["counts"])
+
+    async def _send_one(self, job: BatchJob, index: int):
+        message = job.messages[index]
+        async with self._semaphore:
+            job.results[index] = {"status": "sending"}
+            try:
+                client = self.bot.sessions.get(message["session"]) if message["session"] else self.bot
+                if client is None:
+                    raise LookupError(f"Session {message['session']} is no longer served")
+                response = await client.send(
+                    chat_id=message["chat_id"],
+                    text=message["text"],
+                    reply_to=message["reply_to"],
+                    priority=PRIORITY_BULK,
+                    typing=message["typing"],
+                )
+            except Exception as e:
+                job.results[index] = {"status": "failed", "error": str(e) or type(e).__name__}
+            else:
+                job.results[index] = {"status": "sent", "message_id": (response or {}).get("id")}
+
+    async def stop(self):
+        running = [job.task for job in self._jobs.values() if job.task and not job.task.done()]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
@@ -0,0 +1,117 @@
+import asyncio
+from collections import OrderedDict
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+_MISSING = object()
+
+
+class _FetchCancelled(Exception):
+    """The task running a coalesced fetch was cancelled, its waiters fetch again."""
+
+
+class TTLCache:
+    """
+    LRU cache whose entries expire `ttl` seconds after they were stored.
+
+    `get_or_fetch` coalesces concurrent misses for the same key into a single fetch
+    (single-flight), every waiter gets the same result or the same exception. If the task
+    running the fetch is cancelled, the waiters are not: one of them runs the fetch again.
+    """
+
+    def __init__(self, ttl: float = 300, max_entries: int = 256, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._entries[key]
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self._entries[key] = (self._clock() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def patch(self, key: Hashable, fn: Callable[[Any], Any]) -> bool:
+        # Update a live entry in place without refreshing its expiry
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= self._clock():
+            return False
+        self._entries[key] = (entry[0], fn(entry[1]))
+        return True
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        while True:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                return await self._fetch(key, fetch)
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(inflight)
+            except _FetchCancelled:
+                continue
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            future.set_exception(_FetchCancelled())
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -1,10 +1,55 @@
+import asyncio
+from concurrent.futures import Future
 import re
-from typing import List, Optional, Union
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
 import httpx
 
+from src.cache import TTLCache
+from src.log import get_logger
+from src.metrics import REGISTRY
+from src.prefilter import loads
+from src.transport import RETRY_STATUSES, RetryBudget, RetryPolicy
+
+logger = get_logger("cerebras")
+
+TTFT = REGISTRY.histogram("wahabot_llm_time_to_first_token_seconds", "Time from a streamed LLM request to its first token", ["model"])
+TOKEN_RATE = REGISTRY.histogram("wahabot_llm_tokens_per_second", "Generation speed of streamed LLM replies", ["model"],
+    buckets=(10, 25, 50, 100, 250, 500, 1000, 2000, 4000))
+STREAMS = REGISTRY.counter("wahabot_llm_streams_total", "Streamed LLM requests by outcome", ["model", "outcome"])
+
+_END = object()
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+def _first_line(reply: str) -> Optional[str]:
+    reply = reply.lstrip()
+    return reply.split("\n", 1)[0] if "\n" in reply else None
+
+
+_NUMBERING = re.compile(r"(?:\[(\d+)\]|(\d+)[.):])\s+")
+BATCH_INSTRUCTIONS = (
+    "You will receive {count} numbered messages. Handle each one on its own and reply with exactly {count} lines: "
+    "line N is your answer for message N in the format described above, without the number or any other text."
+)
+
+
 class Cerebras:
+    """
+    Cerebras chat completions client.
+
+    All calls run on one private event loop thread that owns a pooled `httpx.AsyncClient`
+    and the response cache, so async handlers (`aget_llm_response`) never block the bot's
+    loop and legacy sync callers (`get_llm_response`) share the same connections and cache.
+    Identical (model, system prompt, messages) requests are answered from the cache for
+    `cache_ttl` seconds, concurrent identical requests share one call.
+    """
+
     URL = "https://api.cerebras.ai/v1/chat/completions"
-    def __init__(self, api_key: str, system_prompt: str, preferred_model: Optional[str] = None):
+
+    def __init__(self, api_key: str, system_prompt: str, preferred_model: Optional[str] = None,
+        timeout: float = 30, retries: int = 3, cache_ttl: float = 600, cache_size: int = 1024,
+        limits: Optional[httpx.Limits] = None,
+    ):
         if not api_key:
             raise ValueError(f"Missing api key!")
 
@@ -19,6 +64,15 @@ class Cerebras:
         else:
             self.model = None
 
+        self.timeout = timeout
+        self.retry = RetryPolicy(attempts=retries, budget=RetryBudget(ratio=0.2, min_tokens=retries))
+        self.limits = limits or httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60)
+        self.cache = TTLCache(ttl=cache_ttl, max_entries=cache_size)
+        self._http: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
     def _create_messages(self, text: Union[str, List[str]]):
         messages = [{
             "role": "system",
@@ -36,29 +90,239 @@ class Cerebras:
 
         return messages
 
-    def get_llm_response(self, text: Union[str, List[str]], model: Optional[str] = None):
-        messages = self._create_messages(text)
-
+    def _body(self, text: Union[str, List[str]], model: Optional[str]) -> Dict[str, Any]:
         model = model or self.model
         if not model:
             raise ValueError(f"Model to use is unspecified!")
 
-        body = {
+        return {
             "model": model,
             "max_tokens": 5000,
             "temperature": 0.2,
             "top_p": 0.8,
-            "messages": messages,
+            "messages": self._create_messages(text),
         }
 
-        response = httpx.post(self.URL, headers={"Authorization": f"Bearer {self.api_key}"}, json=body)
+    @staticmethod
+    def _cache_key(body: Dict[str, Any]) -> Tuple:
+        return (body["model"], *((m["role"], m["content"]) for m in body["messages"]))
+
+    # Worker loop
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="cerebras", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def _submit(self, coro) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    async def _complete(self, body: Dict[str, Any], fresh: bool) -> str:
+        # Runs on the worker loop only
+        if fresh:
+            self.cache.invalidate(self._cache_key(body))
+        return await self.cache.get_or_fetch(self._cache_key(body), lambda: self._post(body))
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=self.timeout,
+                limits=self.limits,
+            )
+        return self._http
+
+    async def _retrying(self, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        # Completions have no side effects, timeouts and 429/5xx are safe to retry
+        self.retry.budget.deposit()
+        attempt = 0
+        while True:
+            error: Optional[Exception] = None
+            response: Optional[httpx.Response] = None
+            try:
+                response = await send()
+            except httpx.TransportError as e:
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+
+            attempt += 1
+            if attempt >= self.retry.attempts or not self.retry.budget.withdraw():
+                if error is not None:
+                    raise error
+                return response
+
+            delay = self.retry.backoff(attempt)
+            logger.info("Retrying Cerebras call in %.2fs (attempt %d): %s", delay, attempt + 1, error or response.status_code)
+            if response is not None:
+                await response.aclose()
+            await asyncio.sleep(delay)
+
+    async def _post(self, body: Dict[str, Any]) -> str:
+        response = await self._retrying(lambda: self._client().post(self.URL, json=body))
         response.raise_for_status()
+        return response.json().get("choices", [])[0].get("message", {}).get("content").strip()
+
+    async def _stream(self, body: Dict[str, Any], emit: Callable[[str], None]) -> Dict[str, Any]:
+        # Runs on the worker loop, hands each content delta to `emit` and caches the full reply
+        key = self._cache_key(body)
+        cached = self.cache.get(key)
+        if cached is not None:
+            emit(cached)
+            return {"cached": True, "tokens": 0}
+
+        http = self._client()
+        request = http.build_request("POST", self.URL, json={**body, "stream": True})
+        response = await self._retrying(lambda: http.send(request, stream=True))
+        parts: List[str] = []
+        tokens = 0
+        try:
+            if response.is_error:
+                await response.aread()
+                response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = loads(data)
+                choices = chunk.get("choices") or [{}]
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    tokens += 1
+                    emit(delta)
+                usage = chunk.get("usage") or {}
+                tokens = usage.get("completion_tokens", tokens)
+        finally:
+            # Closing early drops the connection, which stops generation
+            await response.aclose()
+
+        self.cache.set(key, "".join(parts).strip())
+        return {"cached": False, "tokens": tokens}
+
+    # Public API
+    async def aget_llm_response(self, text: Union[str, List[str]], model: Optional[str] = None, fresh: bool = False):
+        body = self._body(text, model)
+        llm_response = await asyncio.wrap_future(self._submit(self._complete(body, fresh)))
+        return self.parse_llm_response(llm_response)
+
+    async def astream_llm_response(self, text: Union[str, List[str]], model: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Yields the reply as it is generated. Stopping early (break, `aclose`, cancellation)
+        aborts the request. Records time to first token and tokens per second.
+        """
+        body = self._body(text, model)
+        loop = asyncio.get_running_loop()
+        queue: "asyncio.Queue[Any]" = asyncio.Queue()
+        emit = lambda delta: loop.call_soon_threadsafe(queue.put_nowait, delta)
+        producer = self._submit(self._stream(body, emit))
+        producer.add_done_callback(lambda _: loop.call_soon_threadsafe(queue.put_nowait, _END))
+
+        started = time.monotonic()
+        first_token_at: Optional[float] = None
+        outcome = "cancelled"
+        try:
+            while True:
+                delta = await queue.get()
+                if delta is _END:
+                    break
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                yield delta
 
-        llm_response = response.json().get("choices", [])[0].get("message", {}).get("content").strip()
+            try:
+                stats = producer.result()
+            except Exception:
+                outcome = "error"
+                raise
+            outcome = "cached" if stats["cached"] else "complete"
+            if not stats["cached"] and first_token_at is not None:
+                TTFT.observe(first_token_at - started, model=body["model"])
+                elapsed = time.monotonic() - first_token_at
+                if elapsed > 0:
+                    TOKEN_RATE.observe(stats["tokens"] / elapsed, model=body["model"])
+        finally:
+            producer.cancel()
+            if outcome == "cancelled" and first_token_at is not None:
+                TTFT.observe(first_token_at - started, model=body["model"])
+            STREAMS.inc(model=body["model"], outcome=outcome)
+
+    async def astream_llm_result(self, text: Union[str, List[str]], model: Optional[str] = None,
+        enough: Callable[[str], Optional[str]] = lambda reply: _first_line(reply),
+    ):
+        # `enough` returns the part of the partial reply to parse once it is complete (the first line by default), generation stops there
+        reply = ""
+        stream = self.astream_llm_response(text, model)
+        try:
+            async for delta in stream:
+                reply += delta
+                if enough(reply) is not None:
+                    break
+        finally:
+            await stream.aclose()
+        partial = enough(reply)
+        return self.parse_llm_response(reply if partial is None else partial)
+
+    async def astream_sentences(self, text: Union[str, List[str]], model: Optional[str] = None) -> AsyncIterator[str]:
+        # Yields whole sentences as soon as they are complete, so a reply can be sent piece by piece
+        buffer = ""
+        stream = self.astream_llm_response(text, model)
+        try:
+            async for delta in stream:
+                buffer += delta
+                *sentences, buffer = _SENTENCE_END.split(buffer)
+                for sentence in sentences:
+                    if sentence.strip():
+                        yield sentence.strip()
+        finally:
+            await stream.aclose()
+        if buffer.strip():
+            yield buffer.strip()
+
+    def get_llm_response(self, text: Union[str, List[str]], model: Optional[str] = None, fresh: bool = False):
+        # Blocks the calling thread, from async code use `aget_llm_response`
+        body = self._body(text, model)
+        llm_response = self._submit(self._complete(body, fresh)).result()
         return self.parse_llm_response(llm_response)
 
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._http is not None:
+            asyncio.run_coroutine_threadsafe(self._http.aclose(), loop).result()
+            self._http = None
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    @staticmethod
+    def split_llm_lines(llm_response: str, count: int) -> List[str]:
+        """One answer per line, `[N]`/`N.`/`N)` numbering is dropped. ValueError unless there are `count` lines."""
+        lines = [line.strip() for line in llm_response.strip().splitlines() if line.strip()]
+        if len(lines) != count:
+            raise ValueError(f"Expected {count} lines in the LLM response, got {len(lines)}")
+        for index, line in enumerate(lines, 1):
+            match = _NUMBERING.match(line)
+            if match and int(match.group(1) or match.group(2)) == index:
+                lines[index - 1] = line[match.end():].strip()
+        return lines
+
     @classmethod
-    def parse_llm_response(cls, llm_response: str):
+    def parse_llm_response(cls, llm_response: str, lines: Optional[int] = None):
+        # With `lines`, the response answers that many messages and a list of results is returned
+        if lines is not None:
+            return [cls.parse_llm_response(line) for line in cls.split_llm_lines(llm_response, lines)]
+
         llm_response = llm_response.strip()
         if not llm_response:
             return "", 1  # default if empty
@@ -81,5 +345,125 @@ class Cerebras:
                 return "", float(token)  # score only
             except ValueError:
                 return token, 1  # text only fallback
-            
+
         return "", 1
+
+
+class BatchScorer:
+    """
+    Micro-batches `Cerebras` calls: texts that arrive within `window` seconds of each other,
+    up to `batch_size` of them, go out as one request whose reply has one line per text.
+
+    Cached texts are answered right away and every line of a batch reply is cached as if it
+    came from a single call. When a reply doesn't have one line per text, the texts are sent
+    one by one if `fallback` is set, otherwise their callers get the ValueError.
+    """
+
+    def __init__(self, llm: Cerebras, batch_size: int = 10, window: float = 0.05, fallback: bool = True):
+        self.llm = llm
+        self.batch_size = max(1, batch_size)
+        self.window = max(0, window)
+        self.fallback = fallback
+        # Worker loop state, model: text: waiting futures (identical texts share one slot)
+        self._pending: Dict[str, Dict[str, List[asyncio.Future]]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks = set()
+        self.batches = 0
+        self.fallbacks = 0
+
+    async def score(self, text: str, model: Optional[str] = None):
+        model = self.llm._body(text, model)["model"]
+        llm_response = await asyncio.wrap_future(self.llm._submit(self._enqueue(model, text)))
+        return self.llm.parse_llm_response(llm_response)
+
+    async def flush(self):
+        await asyncio.wrap_future(self.llm._submit(self._flush_all()))
+
+    # Worker loop
+    async def _enqueue(self, model: str, text: str) -> str:
+        cached = self.llm.cache.get(self.llm._cache_key(self.llm._body(text, model)))
+        if cached is not None:
+            return cached
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(model, {})
+        pending.setdefault(text, []).append(future)
+        if len(pending) >= self.batch_size or not self.window:
+            self._spawn(self._send(model, self._take(model)))
+        elif model not in self._timers:
+            self._timers[model] = loop.call_later(self.window, lambda: self._spawn(self._flush(model)))
+        return await future
+
+    async def _flush_all(self):
+        for model in list(self._pending):
+            await self._flush(model)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _take(self, model: str) -> Dict[str, List[asyncio.Future]]:
+        timer = self._timers.pop(model, None)
+        if timer:
+            timer.cancel()
+        return self._pending.pop(model, {})
+
+    async def _flush(self, model: str):
+        await self._send(model, self._take(model))
+
+    async def _send(self, model: str, pending: Dict[str, List[asyncio.Future]]):
+        if not pending:
+            return
+
+        texts = list(pending)
+        if len(texts) == 1:
+            await self._single(model, texts[0], pending[texts[0]])
+            return
+
+        body = self.llm._body(texts, model)
+        numbered = "\n".join(f"[{i}] {' '.join(text.split())}" for i, text in enumerate(texts, 1))
+        body["messages"] = [
+            {"role": "system", "content": self.llm.prompt + "\n\n" + BATCH_INSTRUCTIONS.format(count=len(texts))},
+            {"role": "user", "content": numbered},
+        ]
+        self.batches += 1
+        try:
+            lines = self.llm.split_llm_lines(await self.llm._post(body), len(texts))
+        except ValueError as e:
+            if not self.fallback:
+                self._resolve(pending, error=e)
+                return
+            self.fallbacks += 1
+            logger.info("Batch of %d texts could not be split (%s), scoring them one by one", len(texts), e)
+            await asyncio.gather(*(self._single(model, text, futures) for text, futures in pending.items()))
+            return
+        except Exception as e:
+            self._resolve(pending, error=e)
+            return
+
+        for text, line in zip(texts, lines):
+            self.llm.cache.set(self.llm._cache_key(self.llm._body(text, model)), line)
+            self._resolve({text: pending[text]}, result=line)
+
+    async def _single(self, model: str, text: str, futures: List[asyncio.Future]):
+        try:
+            result = await self.llm._complete(self.llm._body(text, model), fresh=False)
+        except Exception as e:
+            self._resolve({text: futures}, error=e)
+        else:
+            self._resolve({text: futures}, result=result)
+
+    @staticmethod
+    def _resolve(pending: Dict[str, List[asyncio.Future]], result: Any = None, error: Optional[Exception] = None):
+        for futures in pending.values():
+            for future in futures:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,152 @@
+import string
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from src.utils import is_mention
+
+Handler = Callable[..., Awaitable[Any]]
+
+_PUNCT_EXCEPT_AT = "".join(ch for ch in string.punctuation if ch != "@")
+_CLEAN_TABLE = str.maketrans("", "", _PUNCT_EXCEPT_AT)
+
+
+def clean_token(tok: str) -> str:
+    return tok.strip().translate(_CLEAN_TABLE)
+
+
+def mention_id(token: str) -> str:
+    if token.count("@") == 2:
+        token = token.rsplit("@", 1)[0]
+    return token.strip("@")
+
+
+class CommandMatch:
+    """
+    Result of a command lookup.
+
+    Only the leading mentions and the command token are scanned eagerly,
+    `args` and `mentions` tokenize the rest of the text on first access and
+    give the same values as `parse_command`.
+    """
+
+    __slots__ = ("cmd", "handler", "_tokens", "_rest", "_head_mentions", "_extra_args", "_args", "_mentions")
+
+    def __init__(self, cmd: str, handler: Optional[Handler], tokens: List[str], rest: int,
+        head_mentions: List[str], extra_args: List[str],
+    ):
+        self.cmd = cmd
+        self.handler = handler
+        self._tokens = tokens
+        self._rest = rest  # index of the first token after the command
+        self._head_mentions = head_mentions
+        self._extra_args = extra_args
+        self._args: Optional[List[str]] = None
+        self._mentions: Optional[List[str]] = None
+
+    def _scan(self):
+        args = list(self._extra_args)
+        mentions = list(self._head_mentions)
+        for tok in self._tokens[self._rest:]:
+            token = tok.translate(_CLEAN_TABLE)
+            if is_mention(token):
+                mentions.append(mention_id(token))
+            else:
+                args.append(token)
+        self._args = args
+        self._mentions = list(dict.fromkeys(mentions))
+
+    @property
+    def args(self) -> List[str]:
+        if self._args is None:
+            self._scan()
+        return self._args
+
+    @property
+    def mentions(self) -> List[str]:
+        if self._mentions is None:
+            self._scan()
+        return self._mentions
+
+
+class CommandIndex:
+    """
+    Command dispatch table built at registration time.
+
+    - exact commands and aliases resolve with one dict lookup
+    - multi-word commands ("@poll close") are matched longest first
+    - prefix commands ("!") match any token starting with them through a character trie,
+      the rest of the token becomes the first argument. They are matched on the raw token,
+      punctuation included, since it is usually what makes the prefix
+    """
+
+    def __init__(self):
+        self._exact: Dict[str, Handler] = {}
+        self._multi: Dict[str, List[Tuple[Tuple[str, ...], str, Handler]]] = {}  # first word: [(tail words, command, handler)]
+        self._trie: Dict[str, Any] = {}
+        self._has_prefixes = False
+
+    def __contains__(self, command: str) -> bool:
+        return command.strip().lower() in self._exact
+
+    def add(self, command: str, handler: Handler, prefix: bool = False):
+        if prefix:
+            key = command.strip().lower()
+            if not key or len(key.split()) > 1:
+                raise ValueError(f"A prefix command must be a single non-empty token, got {command!r}")
+            node = self._trie
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node[""] = (key, handler)
+            self._has_prefixes = True
+            return
+
+        words = [clean_token(w).lower() for w in command.split()]
+        if not words or not all(words):
+            # Messages are cleaned the same way, "!" would match every message made only of punctuation
+            raise ValueError(f"Command {command!r} is empty without punctuation, register it with prefix=True")
+        if len(words) == 1:
+            self._exact[words[0]] = handler
+        else:
+            options = self._multi.setdefault(words[0], [])
+            options[:] = [o for o in options if o[0] != tuple(words[1:])]
+            options.append((tuple(words[1:]), " ".join(words), handler))
+            options.sort(key=lambda o: len(o[0]), reverse=True)
+
+    def match(self, text: str) -> CommandMatch:
+        tokens = text.split()
+        head_mentions = []
+        for i, tok in enumerate(tokens):
+            token = tok.translate(_CLEAN_TABLE)
+            if is_mention(token):
+                head_mentions.append(mention_id(token))
+                continue
+            # First non-mention token is the command, nothing after it is scanned here
+            return self._resolve(token, tok, tokens, i + 1, head_mentions)
+
+        return CommandMatch("", None, tokens, len(tokens), head_mentions, [])
+
+    def _resolve(self, cmd: str, raw: str, tokens: List[str], rest: int, head_mentions: List[str]) -> CommandMatch:
+        key = cmd.lower()
+
+        for tail, command, handler in self._multi.get(key, ()):
+            end = rest + len(tail)
+            if end <= len(tokens) and tuple(t.translate(_CLEAN_TABLE).lower() for t in tokens[rest:end]) == tail:
+                return CommandMatch(command, handler, tokens, end, head_mentions, [])
+
+        handler = self._exact.get(key)
+        if handler is not None or not self._has_prefixes:
+            return CommandMatch(cmd, handler, tokens, rest, head_mentions, [])
+
+        node = self._trie
+        found = None
+        for depth, ch in enumerate(raw.lower()):
+            node = node.get(ch)
+            if node is None:
+                break
+            if "" in node:
+                found = (depth + 1, node[""])
+        if found is None:
+            return CommandMatch(cmd, None, tokens, rest, head_mentions, [])
+
+        size, (prefix, handler) = found
+        remainder = clean_token(raw[size:])
+        return CommandMatch(prefix, handler, tokens, rest, head_mentions, [remainder] if remainder else [])
@@ -1,23 +1,53 @@
 import asyncio
+from contextlib import asynccontextmanager
+import copy
 import random
+import time
 from typing import Any, Awaitable, Callable, Dict, List, Literal, Optional, Union, overload
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 import httpx
 
+from src.cache import TTLCache
+from src.command_index import CommandIndex
+from src.dedup import EventDeduplicator
+from src.dispatch import EventDispatcher
+from src.log import correlation_id, get_logger
+from src.metrics import OUTBOUND_LATENCY, REGISTRY
+from src.prefilter import EventPrefilter
+from src.ratelimit import PRIORITY_REPLY, OutboundLimiter
+from src.receipts import ReceiptBatcher
+from src.recorder import EventRecorder
+from src.send_scheduler import SendScheduler
+from src.sessions import SessionRegistry
+from src.state import MemoryState
+from src.transport import RequestPolicy, http2_available
 from src.utils import parse_mentions_for_sending
 
+logger = get_logger("client")
+
+
+def _log_failed_send(chat_id: str, future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Failed to send to %s: %s", chat_id, future.exception())
+
 class WAHABot:
     IGNORE_MESSAGES_SET = set()
 
-    MESSAGES_HISTORY: Dict[str, List[str]] = {
-        # chat_id: last_message_id
-    }
-
     def __init__(self, base_url, api_key, session, timeout: float = 10,
         wpm: float = 125, t_min: float = 0.9,t_max: float = 8, jitter: float = 0.2,
-        webhook_func: Callable = lambda *args: print(f"Webhook stub"),
+        webhook_func: Callable = lambda *args: logger.warning("Webhook stub"),
         notifs_admins: List[str] = [],
+        dispatcher: Optional[EventDispatcher] = None,
+        participants_ttl: float = 300, participants_cache_size: int = 256,
+        seen_window: float = 2, seen_batch_size: int = 10,
+        prefilter: bool = True,
+        limits: Optional[httpx.Limits] = None, http2: bool = False,
+        request_policy: Optional[RequestPolicy] = None,
+        limiter: Optional[OutboundLimiter] = None,
+        recorder: Optional[EventRecorder] = None,
+        dedup: Optional[EventDeduplicator] = None,
+        state: Optional[Any] = None,
     ):
         self.base_url = base_url.strip().rstrip("/")
         self.api_key = api_key
@@ -28,6 +58,7 @@ class WAHABot:
         self.t_max = t_max
         self.jitter = jitter
         self._handlers: Dict[str, Callable[..., Awaitable[Any]]] = {}
+        self.commands = CommandIndex()
         self._mentions_handlers: Dict[str, Callable[..., Awaitable[Any]]] = {}
         self._mention_no_cmd_handlers: List[Callable[..., Awaitable[Any]]] = []
         self._no_cmd_handlers: List[Callable[..., Awaitable[Any]]] = []
@@ -38,14 +69,42 @@ class WAHABot:
             "videos": {},
         }
         self.admins = notifs_admins
+        self.dispatcher = dispatcher
+        self._startup_hooks: List[Callable[[], Awaitable[Any]]] = []
+        self._shutdown_hooks: List[Callable[[], Awaitable[Any]]] = []
+        self.scheduler = SendScheduler(self)
+        self.state = state or MemoryState()
+        self.participants = TTLCache(ttl=participants_ttl, max_entries=participants_cache_size)
+        self.receipts = ReceiptBatcher(self, window=seen_window, batch_size=seen_batch_size)
+        self.prefilter = EventPrefilter(self) if prefilter else None
+        self.dedup = dedup
+        self.me: Dict[str, Any] = {}  # last `me` seen in an event of this session
+        self.sessions = SessionRegistry(self)
+        if self.dispatcher:
+            self._startup_hooks.append(self.dispatcher.start)
+            self._shutdown_hooks.append(self.dispatcher.stop)
+        self._shutdown_hooks.append(self.sessions.flush)  # pending sends and receipts of every session
+        self.recorder = recorder
+        if self.recorder:
+            self._startup_hooks.append(self.recorder.start)
+            self._shutdown_hooks.append(self.recorder.stop)  # after the flushes so their calls are recorded
+
+        self.policy = request_policy or RequestPolicy()
+        self.limiter = limiter or OutboundLimiter()
+        if http2 and not http2_available():
+            logger.warning("HTTP/2 requested but the `h2` package is not installed, using HTTP/1.1")
+            http2 = False
 
         self.http = httpx.AsyncClient(
             base_url=self.base_url,
             timeout=self.timeout,
+            limits=limits or httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30),
+            http2=http2,
             headers={
                 "X-Api-Key": self.api_key,
                 "Content-Type": "application/json",
             },
+            event_hooks={"request": [self._tag_request], "response": [self._observe_response]},
         )
 
         def make_webhook_handler(webhook_func):
@@ -53,11 +112,96 @@ class WAHABot:
                 return await webhook_func(self, request)
             return handler
 
-        self.app = FastAPI()
+        @asynccontextmanager
+        async def lifespan(app: FastAPI):
+            for hook in self._startup_hooks:
+                await hook()
+            try:
+                yield
+            finally:
+                for hook in self._shutdown_hooks:
+                    try:
+                        await hook()
+                    except Exception as e:
+                        logger.exception("Shutdown hook %s failed with %s", hook, e)
+                await self.http.aclose()
+
+        self.app = FastAPI(lifespan=lifespan)
         self.app.add_api_route("/", make_webhook_handler(webhook_func), methods=["POST"])
+        self.app.add_api_route("/metrics", self._metrics_endpoint, methods=["GET"])
+
+        REGISTRY.gauge("wahabot_dispatch_queue_depth", "Events waiting for a dispatcher worker",
+            fn=lambda: {(): self.dispatcher.qsize() if self.dispatcher else 0})
+        REGISTRY.gauge("wahabot_dispatch_in_flight", "Events being handled by dispatcher workers",
+            fn=lambda: {(): self.dispatcher.in_flight() if self.dispatcher else 0})
+        REGISTRY.gauge("wahabot_pending_sends", "Messages waiting for their typing delay",
+            fn=lambda: {(): sum(s.scheduler.pending() for s in self.sessions)})
+        REGISTRY.gauge("wahabot_pending_receipts", "Read receipts waiting to be flushed",
+            fn=lambda: {(): sum(s.receipts.pending() for s in self.sessions)})
+        REGISTRY.gauge("wahabot_participants_cache", "Group participants cache counters", ["stat"],
+            fn=lambda: {(k,): v for k, v in self.participants.stats().items()})
+
+    def for_session(self, session: str) -> "WAHABot":
+        # Shares the HTTP pool, handlers, caches and limiter, keeps its own identity, pending sends and receipts
+        view = copy.copy(self)
+        view.session = session
+        view.me = {}
+        view.scheduler = SendScheduler(view, max_delay=self.scheduler.max_delay)
+        view.receipts = ReceiptBatcher(view, window=self.receipts.window, batch_size=self.receipts.batch_size,
+            max_per_chat=self.receipts.max_per_chat)
+        return view
+
+    async def _metrics_endpoint(self) -> Response:
+        return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+    async def _tag_request(self, request: httpx.Request):
+        # Lets WAHA calls be matched to the webhook event that caused them
+        request.headers["X-Correlation-Id"] = correlation_id.get()
+        request.extensions["started_at"] = time.perf_counter()
+        logger.debug("%s %s", request.method, request.url.path)
+
+    async def _observe_response(self, response: httpx.Response):
+        request = response.request
+        started_at = request.extensions.get("started_at")
+        duration = time.perf_counter() - started_at if started_at is not None else None
+        if duration is not None:
+            OUTBOUND_LATENCY.observe(
+                duration,
+                method=request.method, path=self._route_label(request.url.path), status=str(response.status_code),
+            )
+        if self.recorder:
+            self.recorder.record_call(request.method, request.url.path, response.status_code, duration, request.content)
+
+    def _route_label(self, path: str) -> str:
+        # Chat, group and message ids would make one series per chat
+        parts = []
+        for part in path.split("/"):
+            if part in self.sessions:
+                part = "{session}"
+            elif "@" in part or "%40" in part:
+                part = "{id}"
+            parts.append(part)
+        return "/".join(parts)
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        # Per-endpoint timeout, circuit breaker and budgeted retries, see src/transport.py
+        async def send(timeout: Optional[float]) -> httpx.Response:
+            if timeout is not None:
+                kwargs["timeout"] = timeout
+            started_at = time.perf_counter()
+            try:
+                return await self.http.request(method.upper(), path, **kwargs)
+            except httpx.TransportError:
+                # No response reaches the hook, timeouts and connect errors are observed here
+                OUTBOUND_LATENCY.observe(
+                    time.perf_counter() - started_at, method=method.upper(), path=self._route_label(path), status="error",
+                )
+                raise
+
+        return await self.policy.run(method, path, send)
 
     async def _post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
-        r = await self.http.post(path, json=payload)
+        r = await self._request("post", path, json=payload)
         r.raise_for_status()
         return r.json() if r.content else {}
     
@@ -68,12 +212,12 @@ class WAHABot:
         if payload:
             extra_dict["json"] = payload
             
-        r = await getattr(self.http, method)(path, **extra_dict)
+        r = await self._request(method, path, **extra_dict)
         r.raise_for_status()
         return r.json() if r.content else {}
 
     async def _get(self, path: str) -> Any:
-        r = await self.http.get(path)
+        r = await self._request("get", path)
         r.raise_for_status()
         return r.json() if r.content else {}
 
@@ -88,12 +232,9 @@ class WAHABot:
         }
 
         try:
-            results = await self._post("/api/sendSeen", body)
-            # self.MESSAGES_HISTORY.pop(chat_id, None)
-            self.MESSAGES_HISTORY[chat_id] = []
-            return results
+            return await self._post("/api/sendSeen", body)
         except Exception as e:
-            print(f"Error marking {message_id} in char {chat_id} as seen: {e}")
+            logger.warning("Error marking %s in chat %s as seen: %s", message_id, chat_id, e)
             return None
 
     async def presence(self, chat_id: Optional[str], status: str) -> Dict[str, Any]:
@@ -108,12 +249,68 @@ class WAHABot:
     async def stop_typing(self, chat_id: str):
         return await self.presence(chat_id, "paused")
 
-    async def get_group_members(self, chat_id: str) -> List[Dict[str, Optional[str]]]:
+    async def get_group_members(self, chat_id: str, fresh: bool = False) -> List[Dict[str, Optional[str]]]:
         if not chat_id:
             raise ValueError(f"Missing group chat id!")
-        return await self._get(f"/api/{self.session}/groups/{chat_id}/participants")
+        key = await self._participants_key(chat_id)
+        if fresh:
+            self.participants.invalidate(key)
+        # Concurrent misses for the same group share a single request
+        return await self.participants.get_or_fetch(
+            key, lambda: self._get(f"/api/{self.session}/groups/{chat_id}/participants")
+        )
+
+    async def _participants_key(self, chat_id: str) -> tuple:
+        # With shared state the key carries the group's version, a change handled by another worker makes this copy miss
+        version = await self.state.aversion(f"participants:{self.session}:{chat_id}") if self.state.shared else 0
+        return (self.session, chat_id, version)
+
+    async def apply_group_event(self, chat_id: str, action: str, participants: List[Dict[str, Optional[str]]]):
+        key = await self._participants_key(chat_id)
+        if self.state.shared:
+            # Other workers refetch, this one keeps its patched copy under the new version
+            version = await self.state.abump(f"participants:{self.session}:{chat_id}")
+            members = self.participants.get(key)
+            self.participants.invalidate(key)
+            key = (self.session, chat_id, version)
+            if members is not None:
+                self.participants.set(key, members)
+
+        if action not in ("join", "leave", "promote", "demote") or not participants:
+            self.participants.invalidate(key)
+            return
+
+        changed = {p.get("id"): p for p in participants if p.get("id")}
+
+        def matches(member: Dict[str, Optional[str]]) -> Optional[str]:
+            for field in ("id", "lid", "jid"):
+                if member.get(field) in changed:
+                    return member.get(field)
+            return None
 
-    async def _create_poll(self, chat_id: str, name: str, options: List[str], multi: bool = False, reply_to: str = "") -> Dict[str, Any]:
+        def apply(members: List[Dict[str, Optional[str]]]) -> List[Dict[str, Optional[str]]]:
+            if action == "leave":
+                return [m for m in members if not matches(m)]
+
+            updated = []
+            seen = set()
+            for member in members:
+                member_id = matches(member)
+                if member_id:
+                    seen.add(member_id)
+                    if action in ("promote", "demote"):
+                        member = {**member, "admin": changed[member_id].get("admin")}
+                updated.append(member)
+            if action == "join":
+                updated += [p for pid, p in changed.items() if pid not in seen]
+            return updated
+
+        if not self.participants.patch(key, apply):
+            logger.debug("Group %s is not cached, nothing to patch for %s", chat_id, action)
+
+    async def _create_poll(self, chat_id: str, name: str, options: List[str], multi: bool = False, reply_to: str = "",
+        priority: int = PRIORITY_REPLY,
+    ) -> Dict[str, Any]:
         body = {
             "chatId": chat_id,
             "session": self.session,
@@ -127,13 +324,18 @@ class WAHABot:
         if reply_to:
             body["reply_to"] = reply_to
 
+        await self.limiter.acquire(self.session, chat_id, priority)
         return await self._post("/api/sendPoll", body)
 
-    async def create_poll(self, chat_id: str, name: str, options: List[str], multi: bool = False, reply_to: str = "") -> Dict[str, Any]:
+    async def create_poll(self, chat_id: str, name: str, options: List[str], multi: bool = False, reply_to: str = "",
+        priority: int = PRIORITY_REPLY,
+    ) -> Dict[str, Any]:
         mark_seen_error = await self.mark_chat_as_seen(chat_id, reply_to)
-        return await self._create_poll(chat_id, name, options, multi, reply_to)
+        return await self._create_poll(chat_id, name, options, multi, reply_to, priority)
 
-    async def _send_text(self, chat_id: str, text: str, reply_to: Optional[str] = None, mentions: List[str] = []):
+    async def _send_text(self, chat_id: str, text: str, reply_to: Optional[str] = None, mentions: List[str] = [],
+        priority: int = PRIORITY_REPLY,
+    ):
         body = {
             "session": self.session,
             "chatId": chat_id,
@@ -145,9 +347,10 @@ class WAHABot:
         if mentions:
             body["mentions"] = mentions
 
+        await self.limiter.acquire(self.session, chat_id, priority)
         return await self._post("/api/sendText", body)
     
-    async def delete_message(self, chat_id: str, message_id: str):
+    async def delete_message(self, chat_id: str, message_id: str, priority: int = PRIORITY_REPLY):
         params = {
             "session": self.session,
             "chatId": chat_id,
@@ -155,48 +358,18 @@ class WAHABot:
         }
         
         url = "/api/{session}/chats/{chatId}/messages/{messageId}".format(**params)
-        
+
+        await self.limiter.acquire(self.session, chat_id, priority)
         return await self._invoke(url, "delete")
 
     async def mark_chat_as_seen(self, chat_id: str, reply_to: Optional[str] = None):
+        # Flushes the pending read receipts of the chat (plus reply_to) in one call
         try:
-            to_mark = list(dict.fromkeys(self.MESSAGES_HISTORY.get(chat_id, []) + ([reply_to] if reply_to else [])))
-            if to_mark:
-                print(f"Marking Seen with {reply_to=}")
-                await self.mark_seen(chat_id, to_mark)
-            else:
-                print(f"No message to mark as seen in {chat_id}")
+            return await self.receipts.flush(chat_id, reply_to)
         except Exception as e:
-            print(f"Error marking as seen in {chat_id}: {e}")
-            if reply_to:
-                self.MESSAGES_HISTORY[chat_id] = [reply_to]
-            else:
-                if len(self.MESSAGES_HISTORY[chat_id]):
-                    self.MESSAGES_HISTORY[chat_id] = [self.MESSAGES_HISTORY[chat_id][-1]]
+            logger.warning("Error marking as seen in %s: %s", chat_id, e)
             return e
 
-    async def prepare_to_send_text(self, chat_id: str, text: str, reply_to: Optional[str] = None, mentions = []):
-        mark_seen_error = await self.mark_chat_as_seen(chat_id, reply_to)
-
-        try:
-            await self.initiate_typing_process(chat_id, text, mentions)
-        except Exception as e:
-            print(f"Error handling `typing...` in {chat_id}: {e}")
-            # Allow to send without typing
-
-    async def initiate_typing_process(self, chat_id, text, mentions = []):
-        try:
-            await self.start_typing(chat_id)
-            await asyncio.sleep(min(self._estimate_typing_seconds(text, mentions), 60))
-        except Exception as e:
-            print(f"Error typing in {chat_id}")
-            raise e
-
-        try:
-            await self.stop_typing(chat_id)
-        except Exception as e:
-            print(f"Error pausing in {chat_id}")
-
     def _estimate_typing_seconds(self, text: str, mentions=[]) -> float:
         cps = (self.wpm * 5.0) / 60.0
         base_len = len(text)
@@ -210,17 +383,45 @@ class WAHABot:
         jitter = base * self.jitter
         return max(self.t_min, min(self.t_max, base + random.uniform(-jitter, jitter)))
 
-    async def send(self, chat_id: str, text: str, reply_to: Optional[str] = None):
+    def send_nowait(self, chat_id: str, text: str, reply_to: Optional[str] = None,
+        priority: int = PRIORITY_REPLY, typing: bool = True,
+    ) -> "asyncio.Future[Dict[str, Any]]":
+        # Returns right away, the typing delay runs on the scheduler's timers
         text, mentions = parse_mentions_for_sending(text)
-        await self.prepare_to_send_text(chat_id, text, reply_to, mentions)
-        return await self._send_text(chat_id, text, reply_to, mentions)
+        return self.scheduler.schedule(chat_id, text, reply_to, mentions, priority, typing)
+
+    async def send(self, chat_id: str, text: str, reply_to: Optional[str] = None, priority: int = PRIORITY_REPLY,
+        typing: bool = True,
+    ):
+        return await self.send_nowait(chat_id, text, reply_to, priority, typing)
+
+    def send_later(self, chat_id: str, text: str, reply_to: Optional[str] = None, priority: int = PRIORITY_REPLY,
+        typing: bool = True,
+    ) -> Dict[str, Any]:
+        # For handlers: the event is done once the reply is scheduled, a failed send is only logged
+        future = self.send_nowait(chat_id, text, reply_to, priority, typing)
+        future.add_done_callback(lambda f: _log_failed_send(chat_id, f))
+        return {"status": "scheduled", "chat_id": chat_id}
+
+    def on_startup(self, fn: Callable[[], Awaitable[Any]]) -> Callable[[], Awaitable[Any]]:
+        # Runs once the dispatcher is up, before the first request is served
+        self._startup_hooks.append(fn)
+        return fn
+
+    def on_shutdown(self, fn: Callable[[], Awaitable[Any]]) -> Callable[[], Awaitable[Any]]:
+        # Runs before pending sends are flushed and the HTTP pool is closed
+        self._shutdown_hooks.insert(0, fn)
+        return fn
 
     # Decorators
-    def on(self, command: str) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
-        key = command.strip().lower()
+    def on(self, command: str, *aliases: str, prefix: bool = False) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
+        # prefix=True matches any token starting with the command, e.g. "!" for "!ban"
+        keys = [c.strip().lower() for c in (command, *aliases)]
 
         def deco(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
-            self._handlers[key] = fn
+            for key in keys:
+                self.commands.add(key, fn, prefix=prefix)  # raises before anything is registered for a bad command
+                self._handlers[key] = fn
             return fn
 
         return deco
@@ -0,0 +1,84 @@
+import time
+from typing import Any, Callable, Dict, Optional, Set
+
+
+def event_key(evt: Dict[str, Any]) -> Optional[str]:
+    # A redelivered message keeps its message id, other events only have the event id
+    payload = evt.get("payload")
+    message_id = payload.get("id") if isinstance(payload, dict) else None
+    if isinstance(message_id, str) and message_id:
+        return f"{evt.get('session', '')}:{evt.get('event')}:{message_id}"
+    event_id = evt.get("id")
+    if isinstance(event_id, str) and event_id:
+        return f"{evt.get('session', '')}:{event_id}"
+    return None
+
+
+class EventDeduplicator:
+    """
+    Drops events whose message/event id was already seen within `window` seconds.
+
+    Two generations of sets rotate every `window / 2` seconds, or sooner once the current one
+    holds half of `max_entries`, so lookups are O(1) and memory is bounded. A key is remembered
+    for at least half a window and at most a full one. With a shared `state`, keys not seen
+    locally are marked there too so workers and replicas drop each other's duplicates.
+    """
+
+    def __init__(self, window: float = 300, max_entries: int = 100_000, state: Optional[Any] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.window = window
+        self.max_entries = max(2, max_entries)
+        self.state = state if state is not None and state.shared else None
+        self._clock = clock
+        self._current: Set[str] = set()
+        self._previous: Set[str] = set()
+        self._rotated_at = clock()
+        self.duplicates = 0
+        self.unkeyed = 0
+
+    def _rotate(self, now: float):
+        if now - self._rotated_at >= self.window:
+            self._previous = set()  # both generations are stale
+            self._current = set()
+        else:
+            self._previous = self._current
+            self._current = set()
+        self._rotated_at = now
+
+    async def is_duplicate(self, evt: Dict[str, Any]) -> bool:
+        key = event_key(evt)
+        if key is None:
+            self.unkeyed += 1
+            return False
+
+        now = self._clock()
+        if now - self._rotated_at >= self.window / 2 or len(self._current) >= self.max_entries // 2:
+            self._rotate(now)
+
+        if key in self._current or key in self._previous:
+            self.duplicates += 1
+            return True
+        self._current.add(key)
+
+        if self.state is not None and not await self.state.amark("dedup", key, self.window):
+            self.duplicates += 1
+            return True
+        return False
+
+    async def forget(self, evt: Dict[str, Any]):
+        # The event was not processed after all (e.g. rejected for a full queue), let its retry through
+        key = event_key(evt)
+        if key is None:
+            return
+        self._current.discard(key)
+        self._previous.discard(key)
+        if self.state is not None:
+            await self.state.aunmark("dedup", key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._current) + len(self._previous),
+            "duplicates": self.duplicates,
+            "unkeyed": self.unkeyed,
+        }
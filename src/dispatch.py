@@ -0,0 +1,178 @@
+import asyncio
+from collections import deque
+from itertools import count
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Literal, Optional, Set, Tuple
+
+from src.log import get_logger
+
+logger = get_logger("dispatch")
+
+OverflowPolicy = Literal["drop", "oldest", "reject"]
+OVERFLOW_POLICIES = ("drop", "oldest", "reject")
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class EventDispatcher:
+    """
+    Bounded worker pool that runs webhook handlers off the request path.
+
+    Jobs are grouped into lanes by key (the chat id for webhook events). A lane
+    runs its jobs one at a time in arrival order while different lanes run in
+    parallel on the worker pool, so a slow chat only delays itself. Lanes are
+    evicted as soon as they go idle, and `max_lanes` caps how many chats can
+    have pending work at once.
+
+    `submit` never awaits, so the `/` route can acknowledge WAHA immediately.
+    When the queue (or the lane cap) is full the overflow policy decides what happens:
+    - drop: the new event is discarded
+    - oldest: the oldest queued event is discarded to make room; at the lane cap only an
+      event that is alone in an idle lane is, so its lane is freed for the new chat
+    - reject: the new event is refused (the webhook answers 429 so WAHA retries)
+    """
+
+    def __init__(self, concurrency: int = 4, max_queue: int = 1000,
+        overflow: OverflowPolicy = "reject", drain_timeout: float = 30,
+        max_lanes: int = 1000,
+    ):
+        if concurrency < 1:
+            raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+
+        self.concurrency = concurrency
+        self.max_queue = max(1, max_queue)
+        self.max_lanes = max(1, max_lanes)
+        self.overflow = overflow
+        self.drain_timeout = drain_timeout
+        self._lanes: Dict[Hashable, Deque[Tuple[int, Job]]] = {}
+        self._ready: Optional[asyncio.Queue] = None  # (key, lane), a lane replaced after eviction is skipped
+        self._running: Set[Hashable] = set()
+        self._idle: Optional[asyncio.Event] = None
+        self._seq = count()
+        self._workers = []
+        self._pending = 0
+        self._in_flight = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    def qsize(self) -> int:
+        return self._pending
+
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def lanes(self) -> int:
+        return len(self._lanes)
+
+    async def start(self):
+        if self.running:
+            return
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+
+    def submit(self, job: Job, key: Optional[Hashable] = None) -> Literal["queued", "dropped", "rejected"]:
+        if not self.running:
+            raise RuntimeError("Dispatcher is not running")
+
+        if key is None:
+            key = object()  # unkeyed jobs get a lane of their own
+
+        new_lane = key not in self._lanes
+        at_lane_cap = new_lane and len(self._lanes) >= self.max_lanes
+        if self._pending >= self.max_queue or at_lane_cap:
+            if self.overflow == "reject":
+                self.rejected += 1
+                return "rejected"
+
+            self.dropped += 1
+            # Evicting without freeing a lane would lose the queued event and the new one
+            if self.overflow == "drop" or not self._evict_oldest(free_lane=at_lane_cap):
+                return "dropped"
+
+        entry = (next(self._seq), job)
+        if new_lane:
+            lane = self._lanes[key] = deque([entry])
+            self._ready.put_nowait((key, lane))
+        else:
+            # The lane is already scheduled or running, its worker picks this up next
+            self._lanes[key].append(entry)
+
+        self._pending += 1
+        self._idle.clear()
+        return "queued"
+
+    def _evict_oldest(self, free_lane: bool = False) -> bool:
+        # free_lane: only a lane that is empty afterwards and not running can go, it is removed
+        oldest_key = None
+        oldest_seq = None
+        for key, lane in self._lanes.items():
+            if not lane or (free_lane and (len(lane) > 1 or key in self._running)):
+                continue
+            if oldest_seq is None or lane[0][0] < oldest_seq:
+                oldest_key, oldest_seq = key, lane[0][0]
+
+        if oldest_key is None:
+            return False
+
+        self._lanes[oldest_key].popleft()
+        self._pending -= 1
+        if free_lane:
+            del self._lanes[oldest_key]  # its scheduled entry is skipped by the worker
+        return True
+
+    async def stop(self, drain: bool = True):
+        if not self.running:
+            return
+
+        if drain:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=self.drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Dispatcher drain timed out with %d events left", self.qsize())
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _worker(self, index: int):
+        while True:
+            key, lane = await self._ready.get()
+            if self._lanes.get(key) is not lane or not lane:
+                # Every queued job of this lane was evicted by the overflow policy
+                if self._lanes.get(key) is lane:
+                    del self._lanes[key]
+                self._check_idle()
+                continue
+
+            _, job = lane.popleft()
+            self._pending -= 1
+            self._in_flight += 1
+            self._running.add(key)
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.exception("Dispatcher worker %d job for %s failed with %s", index, key, e)
+            finally:
+                self._in_flight -= 1
+                self._running.discard(key)
+                if lane:
+                    self._ready.put_nowait((key, lane))
+                else:
+                    self._lanes.pop(key, None)
+                self._check_idle()
+
+    def _check_idle(self):
+        if not self._pending and not self._in_flight:
+            self._idle.set()
@@ -0,0 +1,203 @@
+"""
+Parsed WAHA events as slotted objects.
+
+`parse_message_event` used to build a nested dict per event. These classes keep the few
+values every event needs in slots and compute the rest (mention of the bot, reply context,
+sticker data, push name) on first access. They are read-only `Mapping`s over the keys the
+old dicts had, so handlers that do `parsed.get("is_group")` or `parsed["me"]` keep working.
+"""
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from src.mentions import MentionEngine, MentionScan, cleanup_label
+from src.utils import is_target
+
+_UNSET = object()
+
+
+def make_reply_id(message_id: str, chat_id: str, participant: str, is_sender_me: Optional[bool] = None, me: Any = {}):
+    if is_sender_me is None:
+        is_sender_me = is_target(participant, me.get("id", ""), me.get("jid", ""), me.get("lid", ""))
+    return f"{str(is_sender_me).lower()}_{chat_id}_{message_id}_{participant}"
+
+
+class _Record(Mapping):
+    __slots__ = ()
+    _KEYS: Tuple[str, ...] = ()
+
+    def keys(self) -> Tuple[str, ...]:
+        return self._KEYS
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.keys():
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key) if key in self.keys() else default
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.keys()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {k: v.to_dict() if isinstance(v, _Record) else v for k, v in self.items()}
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class Identity(_Record):
+    """The bot's own ids in a session, `lid` is already cleaned up (no device suffix)."""
+
+    __slots__ = ("id", "jid", "lid", "mentions")
+    _KEYS = ("id", "jid", "lid")
+
+    def __init__(self, id: Optional[str], jid: Optional[str], lid: str):
+        self.id = id
+        self.jid = jid
+        self.lid = lid
+        self.mentions = MentionEngine(id, jid, lid)
+
+    def is_me(self, target_id: Optional[str]) -> bool:
+        return self.mentions.is_me(target_id)
+
+
+# session: (raw `me` of the last event, its Identity)
+_identities: Dict[str, Tuple[Dict[str, Any], Identity]] = {}
+
+
+def identity(session: str, me: Dict[str, Any]) -> Identity:
+    # `me` only changes when the session is paired again, parse it once per session
+    cached = _identities.get(session)
+    if cached is not None and cached[0] == me:
+        return cached[1]
+    parsed = Identity(me.get("id"), me.get("jid"), cleanup_label(me.get("lid")))
+    if len(_identities) >= 1024:
+        _identities.clear()
+    _identities[session] = (me, parsed)
+    return parsed
+
+
+class SessionEvent(_Record):
+    __slots__ = ("mode", "session")
+    _KEYS = ("type", "mode")
+    type = "session"
+
+    def __init__(self, mode: str, session: Optional[str] = None):
+        self.mode = mode  # STARTING, SCAN_QR_CODE, WORKING, STOPPED...
+        self.session = session
+
+
+class GroupEvent(_Record):
+    __slots__ = ("chat_id", "action", "participants")
+    _KEYS = ("type", "chat_id", "action", "participants")
+    type = "group"
+
+    def __init__(self, chat_id: Optional[str], action: Optional[str], participants: List[Dict[str, Optional[str]]]):
+        self.chat_id = chat_id
+        self.action = action  # join, leave, promote, demote, update
+        self.participants = participants
+
+
+# Keys of the old dicts: a full message, one without a body (only media), one with an invalid `me`
+MESSAGE_KEYS = (
+    "is_group", "is_chat", "sender", "sender_label", "chat_id", "reply_id", "should_reply", "text",
+    "is_mentioned", "is_reply", "reply_history", "reply_history_id", "me", "media",
+)
+NO_BODY_KEYS = ("chat_id", "reply_id", "should_reply", "media")
+INVALID_KEYS = ("chat_id", "reply_id", "should_reply")
+
+
+class MessageEvent(_Record):
+    __slots__ = (
+        "raw", "session", "chat_id", "reply_id", "should_reply", "text", "is_group", "is_chat", "sender",
+        "sender_label", "me", "_keys", "_payload", "_data", "_scan", "_mentioned", "_reply", "_media",
+    )
+    type = None  # old message dicts had no type
+
+    def __init__(self, raw: Dict[str, Any], payload: Dict[str, Any], data: Dict[str, Any], chat_id: Optional[str],
+        reply_id: Optional[str], me: Optional[Identity] = None, should_reply: bool = False, text: str = "",
+        sender: Optional[str] = None, sender_label: Optional[str] = None, keys: Tuple[str, ...] = MESSAGE_KEYS,
+    ):
+        self.raw = raw
+        self.session = raw.get("session")
+        self.chat_id = chat_id
+        self.reply_id = reply_id
+        self.should_reply = should_reply
+        self.text = text
+        chat_type = chat_id.rsplit("@", 1)[-1].strip()[:1].lower() if chat_id else ""
+        self.is_group = chat_type == "g"
+        self.is_chat = chat_type == "c"
+        self.sender = sender
+        self.sender_label = sender_label
+        self.me = me
+        self._keys = keys
+        self._payload = payload
+        self._data = data
+        self._scan: Optional[MentionScan] = None
+        self._mentioned = _UNSET
+        self._reply = _UNSET
+        self._media = _UNSET
+
+    def keys(self) -> Tuple[str, ...]:
+        return self._keys
+
+    @property
+    def scan(self) -> MentionScan:
+        if self._scan is None:
+            self._scan = MentionScan(self.text)
+        return self._scan
+
+    @property
+    def mentioned_ids(self) -> Set[str]:
+        # Numbers mentioned as `@<digits>`, with or without a domain
+        return self.scan.ids
+
+    @property
+    def is_mentioned(self) -> bool:
+        if self._mentioned is _UNSET:
+            self._mentioned = bool(self.text and self.me) and self.me.mentions.mentions_me(self.scan)
+        return self._mentioned
+
+    def _reply_context(self) -> Tuple[bool, Optional[str], Optional[str]]:
+        if self._reply is _UNSET:
+            reply_to = self._payload.get("replyTo") or {}
+            me = self.me
+            reply_id = None
+            if reply_to:
+                participant = reply_to.get("participant", "")
+                reply_id = make_reply_id(reply_to.get("id", ""), self.chat_id, participant, bool(me) and me.is_me(participant))
+            is_reply = bool(me) and me.is_me(reply_to.get("participant"))
+            self._reply = (is_reply, reply_to.get("body"), reply_id)
+        return self._reply
+
+    @property
+    def is_reply(self) -> bool:
+        # The message replies to one of the bot's
+        return self._reply_context()[0]
+
+    @property
+    def reply_history(self) -> Optional[str]:
+        return self._reply_context()[1]
+
+    @property
+    def reply_history_id(self) -> Optional[str]:
+        return self._reply_context()[2]
+
+    @property
+    def media(self) -> Dict[str, Any]:
+        if self._media is _UNSET:
+            sticker = (self._data.get("message") or {}).get("stickerMessage") or {}
+            sticker_data = {"hash": sticker.get("fileSha256", ""), "key": sticker.get("mediaKey", "")} if sticker else {}
+            self._media = {"sticker": sticker_data}
+        return self._media
+
+    @property
+    def push_name(self) -> Optional[str]:
+        return self._data.get("pushName") or None
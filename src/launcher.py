@@ -0,0 +1,351 @@
+"""
+Runs N webhook worker processes behind a small router that keeps each chat on one worker.
+
+Every worker is a regular `uvicorn main:app` process listening on a unix socket. The router
+owns the public port, reads the chat id of each request (`payload.from` of WAHA events) and
+forwards it to the worker that a consistent hash ring assigns to that chat, so a chat's
+state and ordering live in a single process. A worker that dies is taken off the ring,
+which moves only its chats, and put back once it was restarted and answers again.
+
+Batch job ids start with the index of the worker that runs the job, status requests go
+back to it. Adding or removing a session is sent to every worker and replayed to
+restarted ones, so all of them serve the same sessions.
+"""
+import asyncio
+from bisect import bisect
+from contextlib import asynccontextmanager
+import hashlib
+import os
+import signal
+import subprocess
+import sys
+import time
+import re
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Request, Response
+import httpx
+
+from src.log import get_logger
+from src.prefilter import loads
+
+logger = get_logger("launcher")
+
+# Hop-by-hop headers, and ones httpx sets itself
+_SKIP_HEADERS = {"host", "connection", "keep-alive", "transfer-encoding", "content-length", "upgrade"}
+_JOB_RE = re.compile(r"^/send/batch/w(\d+)-")
+
+
+def job_prefix(index: int) -> str:
+    """Start of the batch job ids of worker `index`."""
+    return f"w{index}-"
+
+
+def job_worker(path: str) -> Optional[int]:
+    """Worker that runs the batch job of a status request, None for other requests."""
+    match = _JOB_RE.match(path)
+    return int(match.group(1)) if match else None
+
+
+def session_change(method: str, path: str, body: bytes) -> Optional[str]:
+    """Name of the session a request adds or removes, None for other requests."""
+    if method == "DELETE" and path.startswith("/sessions/"):
+        return path[len("/sessions/"):] or None
+    if method == "POST" and path == "/sessions":
+        try:
+            data = loads(body)
+        except ValueError:
+            return None
+        name = data.get("name") if isinstance(data, dict) else None
+        return name.strip() if isinstance(name, str) and name.strip() else None
+    return None
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing with `replicas` virtual nodes per worker, removing a worker only moves its keys."""
+
+    def __init__(self, replicas: int = 128):
+        self.replicas = replicas
+        self._points: List[int] = []
+        self._owners: List[int] = []
+        self._nodes: set = set()
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, node: int) -> bool:
+        return node in self._nodes
+
+    def _rebuild(self):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self._nodes for i in range(self.replicas))
+        self._points = [p for p, _ in points]
+        self._owners = [n for _, n in points]
+
+    def add(self, node: int):
+        if node not in self._nodes:
+            self._nodes.add(node)
+            self._rebuild()
+
+    def remove(self, node: int):
+        if node in self._nodes:
+            self._nodes.discard(node)
+            self._rebuild()
+
+    def get(self, key: str) -> Optional[int]:
+        if not self._points:
+            return None
+        index = bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[index]
+
+
+def shard_key(path: str, body: bytes) -> Optional[str]:
+    """Chat id a request belongs to, None when any worker can answer it."""
+    if path.startswith("/pull/"):
+        return path[len("/pull/"):].split("/", 1)[0]
+    if not body:
+        return None
+    try:
+        data = loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    if data.get("chat_id"):  # /send
+        return str(data["chat_id"])
+    payload = data.get("payload")
+    if isinstance(payload, dict):
+        group = payload.get("group")
+        chat_id = payload.get("from") or (group.get("id") if isinstance(group, dict) else None) or payload.get("chatId")
+        if isinstance(chat_id, str) and chat_id:
+            return chat_id
+    return None
+
+
+class _Worker:
+    __slots__ = ("index", "socket", "process", "client", "restarts", "started_at")
+
+    def __init__(self, index: int, socket: str, connections: int = 100):
+        self.index = index
+        self.socket = socket
+        self.process: Optional[subprocess.Popen] = None
+        # Every connection is kept alive: with httpx's default of 20, bursts opened and closed sockets per request
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+        self.client = httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(uds=socket, limits=limits), base_url="http://worker", timeout=None)
+        self.restarts = 0
+        self.started_at = 0.0
+
+
+class Launcher:
+    def __init__(self, workers: int, app: str = "main:app", socket_dir: str = "/tmp", replicas: int = 128,
+        log_level: str = "warning", max_backoff: float = 30,
+    ):
+        self.app_path = app
+        self.log_level = log_level
+        self.max_backoff = max_backoff
+        self.ring = HashRing(replicas)
+        self.workers = [_Worker(i, os.path.join(socket_dir, f"wahabot-{os.getpid()}-{i}.sock")) for i in range(max(1, workers))]
+        self._supervisor: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._next = 0
+        self._tasks = set()
+        # session name: last successful add or remove (method, path, body, headers), replayed to restarted workers
+        self._session_changes: Dict[str, Tuple[str, str, bytes, List[Tuple[str, str]]]] = {}
+
+    # Processes
+    def _spawn(self, worker: _Worker):
+        if os.path.exists(worker.socket):
+            os.unlink(worker.socket)
+        env = {**os.environ, "WAHABOT_WORKER": str(worker.index)}
+        worker.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", self.app_path, "--uds", worker.socket, "--log-level", self.log_level, "--no-access-log"],
+            env=env,
+        )
+        worker.started_at = time.monotonic()
+
+    async def _wait_ready(self, worker: _Worker, timeout: float = 60) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and worker.process and worker.process.poll() is None:
+            try:
+                response = await worker.client.get("/healthcheck")
+                if response.status_code == 200:
+                    return True
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+        return False
+
+    async def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        ready = await asyncio.gather(*(self._wait_ready(w) for w in self.workers))
+        for worker, ok in zip(self.workers, ready):
+            if ok:
+                self.ring.add(worker.index)
+            else:
+                logger.error("Worker %d did not come up", worker.index)
+        logger.info("Started %d/%d workers", len(self.ring), len(self.workers))
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    async def _supervise(self):
+        while not self._stopping:
+            await asyncio.sleep(0.5)
+            for worker in self.workers:
+                if worker.process is None or worker.process.poll() is None or self._stopping:
+                    continue
+                # Only this worker's chats move while it restarts
+                self.ring.remove(worker.index)
+                code = worker.process.returncode
+                worker.process = None
+                task = asyncio.create_task(self._restart(worker, code))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _restart(self, worker: _Worker, code: Optional[int]):
+        # Backoff grows with crashes that follow a short run
+        worker.restarts = worker.restarts + 1 if time.monotonic() - worker.started_at < 60 else 1
+        delay = min(self.max_backoff, 0.5 * 2 ** (worker.restarts - 1))
+        logger.warning("Worker %d exited with %s, restarting in %.1fs", worker.index, code, delay)
+        await asyncio.sleep(delay)
+        if self._stopping:
+            return
+        try:
+            self._spawn(worker)
+            if await self._wait_ready(worker):
+                await self._replay_sessions(worker)
+                self.ring.add(worker.index)
+                logger.info("Worker %d is back", worker.index)
+        except Exception as e:
+            # It stays off the ring, `/launcher` shows it as not alive
+            logger.exception("Restarting worker %d failed with %s", worker.index, e)
+
+    async def _replay_sessions(self, worker: _Worker):
+        for name, (method, path, body, headers) in list(self._session_changes.items()):
+            try:
+                await worker.client.request(method, path, content=body, headers=headers)
+            except httpx.TransportError as e:
+                logger.warning("Could not replay session %s to worker %d: %s", name, worker.index, e)
+
+    async def stop(self):
+        self._stopping = True
+        if self._supervisor:
+            self._supervisor.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        for worker in self.workers:
+            if worker.process and worker.process.poll() is None:
+                worker.process.send_signal(signal.SIGTERM)  # workers flush pending sends on shutdown
+        for worker in self.workers:
+            if worker.process:
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, worker.process.wait, 30)
+                except subprocess.TimeoutExpired:
+                    worker.process.kill()
+            await worker.client.aclose()
+            if os.path.exists(worker.socket):
+                os.unlink(worker.socket)
+
+    # Routing
+    def pick(self, path: str, body: bytes, query: Dict[str, str]) -> Optional[_Worker]:
+        if "worker" in query:  # e.g. /metrics?worker=2
+            try:
+                index = int(query["worker"])
+            except ValueError:
+                return None
+            return self.workers[index] if 0 <= index < len(self.workers) and index in self.ring else None
+
+        index = job_worker(path)
+        if index is not None:
+            # Only that worker knows the job, unless state is shared
+            return self.workers[index] if index < len(self.workers) and index in self.ring else None
+
+        key = shard_key(path, body)
+        if key is not None:
+            index = self.ring.get(key)
+            return None if index is None else self.workers[index]
+
+        live = [w for w in self.workers if w.index in self.ring]
+        if not live:
+            return None
+        self._next = (self._next + 1) % len(live)
+        return live[self._next]
+
+    async def _broadcast(self, request: Request, body: bytes, headers: List[Tuple[str, str]], session: str) -> Response:
+        # Every worker has to serve the session, the answer is the first worker's
+        live = [w for w in self.workers if w.index in self.ring]
+        if not live:
+            return Response(b'{"status": "unavailable"}', status_code=503, media_type="application/json")
+        results = await asyncio.gather(
+            *(w.client.request(request.method, request.url.path, content=body, headers=headers) for w in live),
+            return_exceptions=True,
+        )
+        for worker, result in zip(live, results):
+            if isinstance(result, Exception):
+                # A restart replays the change to it
+                logger.warning("Worker %d missed the change of session %s: %s", worker.index, session, result)
+        upstream = next((r for r in results if not isinstance(r, Exception)), None)
+        if upstream is None:
+            return Response(b'{"status": "unavailable"}', status_code=503, media_type="application/json")
+        if upstream.is_success:
+            self._session_changes.pop(session, None)
+            self._session_changes[session] = (request.method, request.url.path, body, headers)
+        response_headers = {k: v for k, v in upstream.headers.items() if k.lower() not in _SKIP_HEADERS}
+        return Response(upstream.content, status_code=upstream.status_code, headers=response_headers)
+
+    async def forward(self, request: Request) -> Response:
+        body = await request.body()
+        headers = [(k, v) for k, v in request.headers.items() if k.lower() not in _SKIP_HEADERS]
+        session = session_change(request.method, request.url.path, body)
+        if session is not None:
+            return await self._broadcast(request, body, headers, session)
+
+        worker = self.pick(request.url.path, body, dict(request.query_params))
+        if worker is None:
+            return Response(b'{"status": "unavailable"}', status_code=503, media_type="application/json")
+
+        try:
+            upstream = await worker.client.request(
+                request.method, request.url.path, params=request.query_params, content=body, headers=headers,
+            )
+        except httpx.TransportError as e:
+            # WAHA retries the event, by then the worker is back or off the ring
+            logger.warning("Worker %d unreachable: %s", worker.index, e)
+            return Response(b'{"status": "unavailable"}', status_code=503, media_type="application/json")
+
+        response_headers = {k: v for k, v in upstream.headers.items() if k.lower() not in _SKIP_HEADERS}
+        return Response(upstream.content, status_code=upstream.status_code, headers=response_headers)
+
+    def create_app(self) -> FastAPI:
+        @asynccontextmanager
+        async def lifespan(app: FastAPI):
+            await self.start()
+            try:
+                yield
+            finally:
+                await self.stop()
+
+        app = FastAPI(lifespan=lifespan)
+
+        @app.get("/launcher")
+        async def status():
+            return {
+                "workers": [
+                    {"index": w.index, "alive": w.index in self.ring, "pid": w.process.pid if w.process else None, "restarts": w.restarts}
+                    for w in self.workers
+                ],
+            }
+
+        app.add_api_route("/{path:path}", self.forward, methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+        return app
+
+
+def run_launcher(workers: int, host: str = "0.0.0.0", port: int = 8000, app: str = "main:app", socket_dir: str = "/tmp",
+    log_level: str = "warning",
+) -> None:
+    import uvicorn
+
+    launcher = Launcher(workers, app=app, socket_dir=socket_dir, log_level=log_level)
+    uvicorn.run(launcher.create_app(), host=host, port=port, log_level=log_level, access_log=False)
@@ -0,0 +1,107 @@
+import contextvars
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import uuid
+from typing import Any, Awaitable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+LOGGER_NAME = "wahabot"
+# Lines logged on this logger are printed for every event, they are the ones sampled
+EVENTS_LOGGER_NAME = f"{LOGGER_NAME}.events"
+
+correlation_id: contextvars.ContextVar[str] = contextvars.ContextVar("correlation_id", default="-")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+def new_correlation_id() -> str:
+    cid = uuid.uuid4().hex[:12]
+    correlation_id.set(cid)
+    return cid
+
+
+async def with_correlation_id(cid: str, coro: Awaitable[T]) -> T:
+    # Long lived worker tasks don't inherit the caller's context, this carries the id over
+    token = correlation_id.set(cid)
+    try:
+        return await coro
+    finally:
+        correlation_id.reset(token)
+
+
+class _CorrelationFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class _SamplingFilter(logging.Filter):
+    """Keeps a `rate` fraction of DEBUG/INFO records, warnings and errors always pass."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the event loop, records are dropped when the writer thread falls behind."""
+
+    dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            type(self).dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Correlation id must be read here, the writer thread has no context
+        record.correlation_id = getattr(record, "correlation_id", correlation_id.get())
+        return super().prepare(record)
+
+
+def setup_logging(level: str = "INFO", sample_rate: float = 1.0, queue_size: int = 10000) -> None:
+    global _listener
+    if _listener:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(correlation_id)s] %(name)s: %(message)s"))
+
+    handler = _DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    handler.addFilter(_CorrelationFilter())
+
+    root = logging.getLogger(LOGGER_NAME)
+    root.setLevel(level.upper())
+    root.handlers[:] = [handler]
+    root.propagate = False
+
+    events = logging.getLogger(EVENTS_LOGGER_NAME)
+    events.filters[:] = []
+    if sample_rate < 1:
+        events.addFilter(_SamplingFilter(sample_rate))
+
+    _listener = logging.handlers.QueueListener(handler.queue, stream, respect_handler_level=False)
+    _listener.start()
+
+
+def shutdown_logging() -> None:
+    global _listener
+    if _listener:
+        _listener.stop()  # flushes what is left in the queue
+        _listener = None
+
+
+def logging_stats() -> Dict[str, Any]:
+    return {"dropped": _DroppingQueueHandler.dropped}
@@ -0,0 +1,90 @@
+"""
+Mention detection from one pass over the text.
+
+`MentionScan` walks a message once and collects the numbers mentioned (`@<digits>`), the full
+ids written for sending (`@<digits>@c.us`) and the text with those ids shortened to `@<digits>`.
+`MentionEngine` holds the ids of one identity of the bot as precomputed sets, so checking whether
+a message or a group member is the bot is a set lookup instead of rebuilding ids per call.
+"""
+import re
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple, Union
+
+WA_DOMAINS = ["c.us", "lid", "s.whatsapp.net"]
+DOMAINS_RE = "|".join(re.escape(d) for d in WA_DOMAINS)
+# `@<digits>`, with the domain when the id is written out in full
+SCAN_RE = re.compile(rf"@(\d+)(?:@({DOMAINS_RE}))?")
+
+
+def cleanup_label(my_label_raw):
+    if my_label_raw:
+        _l_i, _l_r = my_label_raw.split("@", 1)
+        _l_i = _l_i.split(":", 1)[0]
+        my_label = f"{_l_i.strip()}@{_l_r.strip()}"
+    else:
+        my_label = ""
+    return my_label
+
+
+def normalize_id(value: Optional[str]) -> Optional[str]:
+    # The number of an id on a WhatsApp domain, without a device suffix
+    if not value or "@" not in value:
+        return None
+    user, domain = value.split("@", 1)
+    if domain.strip() not in WA_DOMAINS:
+        return None
+    return user.split(":", 1)[0].strip() or None
+
+
+class MentionScan:
+    __slots__ = ("ids", "mentions", "text")
+
+    def __init__(self, text: str):
+        self.ids: Set[str] = set()  # numbers mentioned in any form
+        self.mentions: Dict[str, None] = {}  # full ids, in order of appearance
+        self.text = text  # with full ids shortened to `@<digits>`
+        if not text or "@" not in text:
+            return
+
+        parts: List[str] = []
+        last = 0
+        for match in SCAN_RE.finditer(text):
+            number, domain = match.group(1), match.group(2)
+            self.ids.add(number)
+            if domain:
+                self.mentions[f"{number}@{domain}"] = None
+                parts.append(text[last:match.start()])
+                parts.append("@" + number)
+                last = match.end()
+        if parts:
+            parts.append(text[last:])
+            self.text = "".join(parts)
+
+    def for_sending(self) -> Tuple[str, List[str]]:
+        return self.text, list(self.mentions)
+
+
+class MentionEngine:
+    """
+    One identity of the bot (id, jid and lid of a session) as precomputed sets: `ids` for
+    comparing with member and participant ids, `numbers` for matching mentions in a text.
+    """
+
+    __slots__ = ("ids", "numbers")
+
+    def __init__(self, *ids: Optional[str]):
+        self.ids: FrozenSet[str] = frozenset(i for i in ids if i)
+        self.numbers: FrozenSet[str] = frozenset(n for n in map(normalize_id, self.ids) if n)
+
+    @classmethod
+    def for_me(cls, me: Any) -> "MentionEngine":
+        # From an event's `me` or a parsed identity, the lid may carry a device suffix
+        return cls(me.get("id"), me.get("jid"), cleanup_label(me.get("lid")))
+
+    def is_me(self, target_id: Optional[str]) -> bool:
+        return bool(target_id) and target_id in self.ids
+
+    def mentions_me(self, text: Union[str, MentionScan]) -> bool:
+        if not self.numbers:
+            return False
+        scan = text if isinstance(text, MentionScan) else MentionScan(text)
+        return not self.numbers.isdisjoint(scan.ids)
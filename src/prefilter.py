@@ -0,0 +1,109 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+from src.storage import storage_is_enabled
+
+if TYPE_CHECKING:
+    from src.custom_client import WAHABot  # only for type checking
+
+try:
+    import orjson
+
+    def loads(data: bytes) -> Any:
+        return orjson.loads(data)
+except ImportError:
+    import json
+
+    def loads(data: bytes) -> Any:
+        return json.loads(data)
+
+SUPPORTED_EVENTS = {
+    "message",
+    "session.status",
+    "group.v2.participants",
+    "group.v2.join",
+    "group.v2.leave",
+    "group.v2.update",
+    "group.join",
+    "group.leave",
+}
+
+
+class EventPrefilter:
+    """
+    Cheap checks on the raw event that run before `parse_message_event`.
+
+    Only `event`, `payload.fromMe`, `payload._data.status` and the leading command
+    token of the body are looked at. Messages that no registered handler, fallback
+    or storage subscription could use are dropped, their read receipt is still queued
+    like the full path would do.
+    """
+
+    def __init__(self, client: "WAHABot"):
+        self.client = client
+        self.passed = 0
+        self.drops: Dict[str, int] = {}
+
+    def check(self, evt: Any, client: Optional["WAHABot"] = None) -> Optional[str]:
+        # `client` is the session the event was routed to, receipts are queued there
+        reason = self._reason(evt, client or self.client)
+        if reason:
+            self.drops[reason] = self.drops.get(reason, 0) + 1
+        else:
+            self.passed += 1
+        return reason
+
+    def _reason(self, evt: Any, client: "WAHABot") -> Optional[str]:
+        if not isinstance(evt, dict):
+            return "malformed"
+
+        event_type = evt.get("event")
+        if not event_type:
+            return "no_event"
+        if not isinstance(event_type, str):
+            return "malformed"
+        if event_type in client.IGNORE_MESSAGES_SET:
+            return "ignored_event"
+        if event_type not in SUPPORTED_EVENTS:
+            return "unsupported_event"
+        if event_type != "message":
+            return None
+
+        payload = evt.get("payload") or {}
+        if (payload.get("_data") or {}).get("status") == "DELIVERY_ACK":
+            return "delivery_ack"
+        if str(payload.get("fromMe", "")).lower() == "true":
+            return "from_me"
+
+        if client._no_cmd_handlers or client._mention_no_cmd_handlers:
+            return None  # any message may reach a fallback handler
+
+        body = payload.get("body") or ""
+        if not body.strip():
+            if any(client._media_handlers.values()):
+                return None
+            self._queue_receipt(client, payload)
+            return "no_body"
+
+        chat_id = payload.get("from")
+        if chat_id and storage_is_enabled(chat_id):
+            return None
+        if client._mentions_handlers:
+            return None
+        if client.commands.match(body).handler is not None:
+            return None
+
+        self._queue_receipt(client, payload)
+        return "no_handler"
+
+    def _queue_receipt(self, client: "WAHABot", payload: Dict[str, Any]):
+        chat_id = payload.get("from")
+        message_id = payload.get("id")
+        if not chat_id or not message_id:
+            return
+        if chat_id.endswith("@g.us") and chat_id != payload.get("to"):
+            return  # duplicate group delivery, the full path skips these too
+        client.receipts.add(chat_id, message_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"passed": self.passed, "dropped": dict(self.drops)}
@@ -0,0 +1,161 @@
+import asyncio
+from collections import OrderedDict
+import heapq
+from itertools import count
+import time
+from typing import Callable, Dict, List, Optional
+
+from src.metrics import REGISTRY
+
+PRIORITY_ADMIN = 0
+PRIORITY_REPLY = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = {PRIORITY_ADMIN: "admin", PRIORITY_REPLY: "reply", PRIORITY_BULK: "bulk"}
+
+WAIT_TIME = REGISTRY.histogram("wahabot_ratelimit_wait_seconds", "Time outbound calls waited for the rate limiter", ["priority"])
+QUEUE_FULL = REGISTRY.counter("wahabot_ratelimit_rejected_total", "Outbound calls refused because the rate limiter queue was full", ["priority"])
+
+
+class RateLimitQueueFull(Exception):
+    pass
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = now
+
+    def refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboundLimiter:
+    """
+    Token buckets for outbound WAHA calls: one global, one per session and one per chat.
+    A rate of 0 disables that level.
+
+    Calls that find no token wait in a bounded priority queue (admin notifications,
+    then command replies, then bulk sends, FIFO within a class). A single timer is
+    armed for the moment the next waiter can go. Only a full queue fails.
+    """
+
+    def __init__(self, global_rate: float = 10, global_burst: float = 20,
+        session_rate: float = 10, session_burst: float = 20,
+        chat_rate: float = 1, chat_burst: float = 5,
+        max_queue: int = 1000, max_chats: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._clock = clock
+        now = clock()
+        self._global = TokenBucket(global_rate, global_burst, now) if global_rate > 0 else None
+        self.session_rate, self.session_burst = session_rate, session_burst
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.max_queue = max(1, max_queue)
+        self.max_chats = max(1, max_chats)
+        self._sessions: Dict[str, TokenBucket] = {}
+        self._chats: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._waiters: List[list] = []  # heap of [priority, seq, session, chat_id, future, enqueued_at]
+        self._seq = count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        REGISTRY.gauge("wahabot_ratelimit_queue_depth", "Outbound calls waiting for the rate limiter", fn=lambda: {(): len(self._waiters)})
+
+    def _buckets(self, session: str, chat_id: str, now: float) -> List[TokenBucket]:
+        buckets = []
+        if self._global:
+            buckets.append(self._global)
+        if self.session_rate > 0:
+            bucket = self._sessions.get(session)
+            if bucket is None:
+                bucket = self._sessions[session] = TokenBucket(self.session_rate, self.session_burst, now)
+            buckets.append(bucket)
+        if self.chat_rate > 0:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+                if len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)  # the least recently used chat starts over with a full bucket
+            else:
+                self._chats.move_to_end(chat_id)
+            buckets.append(bucket)
+        return buckets
+
+    def _try_take(self, session: str, chat_id: str, now: float) -> float:
+        # 0 when a token was taken from every bucket, else how long until that could happen
+        buckets = self._buckets(session, chat_id, now)
+        wait = max((b.wait_time(now) for b in buckets), default=0.0)
+        if wait <= 0:
+            for bucket in buckets:
+                bucket.take()
+        return wait
+
+    async def acquire(self, session: str, chat_id: str, priority: int = PRIORITY_REPLY):
+        now = self._clock()
+        label = PRIORITY_NAMES.get(priority, str(priority))
+        if not self._waiters and self._try_take(session, chat_id, now) <= 0:
+            WAIT_TIME.observe(0.0, priority=label)
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            QUEUE_FULL.inc(priority=label)
+            raise RateLimitQueueFull(f"Outbound queue is full ({self.max_queue} waiting)")
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), session, chat_id, future, now]
+        heapq.heappush(self._waiters, entry)
+        self._pump()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+        WAIT_TIME.observe(self._clock() - now, priority=label)
+
+    def _pump(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        now = self._clock()
+        next_wait = None
+        finished = set()
+        # Highest priority first, but a waiter blocked on its own chat doesn't hold back other chats
+        for entry in sorted(self._waiters):
+            future = entry[4]
+            if not future.done():
+                wait = self._try_take(entry[2], entry[3], now)
+                if wait > 0:
+                    next_wait = wait if next_wait is None else min(next_wait, wait)
+                    if self._global and self._global.tokens < 1:
+                        # Nobody else can go before the global bucket refills
+                        next_wait = min(next_wait, self._global.wait_time(now))
+                        break
+                    continue
+                future.set_result(None)
+            finished.add(id(entry))
+
+        if finished:
+            self._waiters = [e for e in self._waiters if id(e) not in finished]
+            heapq.heapify(self._waiters)
+
+        if self._waiters:
+            if next_wait is None:
+                next_wait = self._global.wait_time(now) if self._global else 0.0
+            self._timer = asyncio.get_running_loop().call_later(max(next_wait, 0.001), self._pump)
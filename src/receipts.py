@@ -0,0 +1,86 @@
+from __future__ import annotations
+import asyncio
+from typing import TYPE_CHECKING, Dict, Optional
+
+if TYPE_CHECKING:
+    from src.custom_client import WAHABot  # only for type checking
+
+
+class ReceiptBatcher:
+    """
+    Collects read receipts per chat and sends them as one `/api/sendSeen` call.
+
+    A chat is flushed when it holds `batch_size` ids, when `window` seconds passed
+    since its first pending id, or right before the bot sends to it.
+    Only the newest `max_per_chat` ids are kept, older ones are implied read.
+    """
+
+    def __init__(self, bot: "WAHABot", window: float = 2, batch_size: int = 10, max_per_chat: int = 50):
+        self.bot = bot
+        self.window = max(0, window)
+        self.batch_size = max(1, batch_size)
+        self.max_per_chat = max(1, max_per_chat)
+        self._pending: Dict[str, Dict[str, None]] = {}  # chat_id: ordered set of message ids
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks = set()
+
+    def pending(self, chat_id: Optional[str] = None) -> int:
+        if chat_id is not None:
+            return len(self._pending.get(chat_id, ()))
+        return sum(len(ids) for ids in self._pending.values())
+
+    def add(self, chat_id: str, message_id: str):
+        if not chat_id or not message_id:
+            return
+
+        ids = self._pending.setdefault(chat_id, {})
+        ids.pop(message_id, None)
+        ids[message_id] = None
+        while len(ids) > self.max_per_chat:
+            del ids[next(iter(ids))]
+
+        if len(ids) >= self.batch_size or not self.window:
+            self._spawn(self.flush(chat_id))
+        else:
+            self._arm(chat_id, self.window)
+
+    def _arm(self, chat_id: str, delay: float):
+        if chat_id not in self._timers:
+            loop = asyncio.get_running_loop()
+            self._timers[chat_id] = loop.call_later(delay, lambda: self._spawn(self.flush(chat_id)))
+
+    async def flush(self, chat_id: str, reply_to: Optional[str] = None) -> Optional[Exception]:
+        timer = self._timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+
+        ids = list(self._pending.pop(chat_id, {}))
+        if reply_to and reply_to not in ids:
+            ids.append(reply_to)
+        if not ids:
+            return None
+
+        result = await self.bot.mark_seen(chat_id, ids)
+        if result is None:  # mark_seen already logged the failure
+            self._requeue(chat_id, ids[-1])
+            return RuntimeError(f"Failed to mark {len(ids)} messages as seen in {chat_id}")
+        return None
+
+    async def flush_all(self):
+        for chat_id in list(self._pending):
+            await self.flush(chat_id)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _requeue(self, chat_id: str, message_id: str):
+        # Keep only the newest id, marking it seen marks everything before it too
+        ids = self._pending.setdefault(chat_id, {})
+        if message_id not in ids:
+            self._pending[chat_id] = {message_id: None, **ids}
+        # Retried after a window even if the chat stays quiet, not right away while WAHA is failing
+        self._arm(chat_id, self.window or 1)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,223 @@
+import asyncio
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from typing import IO, Any, Dict, Iterator, Optional
+import zlib
+
+from src.log import correlation_id, get_logger
+from src.metrics import REGISTRY
+from src.prefilter import loads
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = get_logger("recorder")
+
+RECORDS = REGISTRY.counter("wahabot_recorder_records_total", "Recorded webhook events and WAHA calls by outcome", ["kind", "outcome"])
+
+# Runs of digits long enough to be phone numbers or lids
+_NUMBER_RE = re.compile(r"\d{7,}")
+# Keys holding names, thumbnails or inline media
+REDACTED_KEYS = {"pushName", "notifyName", "verifiedBizName", "jpegThumbnail", "thumbnail", "data", "url", "directPath"}
+SUFFIXES = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst", "none": ".jsonl"}
+_STOP = object()
+
+
+class Redactor:
+    """
+    Replaces phone numbers and lids with stable pseudonyms of the same length (HMAC of `salt`),
+    so commands, mentions and group membership still line up when a recording is replayed.
+    Names and media are dropped.
+    """
+
+    def __init__(self, salt: str = ""):
+        self._key = (salt or os.urandom(16).hex()).encode()
+        self._cache: Dict[str, str] = {}
+
+    def number(self, digits: str) -> str:
+        pseudonym = self._cache.get(digits)
+        if pseudonym is None:
+            digest = hmac.new(self._key, digits.encode(), hashlib.sha256).hexdigest()
+            pseudonym = str(int(digest, 16))[:len(digits)].rjust(len(digits), "0")
+            if len(self._cache) < 100_000:
+                self._cache[digits] = pseudonym
+        return pseudonym
+
+    def __call__(self, value: Any) -> Any:
+        if isinstance(value, str):
+            return _NUMBER_RE.sub(lambda m: self.number(m.group()), value)
+        if isinstance(value, dict):
+            return {k: "<redacted>" if k in REDACTED_KEYS and v else self(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self(v) for v in value]
+        return value
+
+
+class EventRecorder:
+    """
+    Records raw webhook events and the WAHA calls they caused to compressed JSONL segments.
+
+    Every line is `{"ts", "kind", "cid", ...}`: events carry the raw payload under `event`
+    (the format `bench.bench_webhook --replay` reads), calls carry method, path, status,
+    duration and the request body. An event and its calls share the correlation id, which
+    is also what `sample_rate` samples on, so either all of them are recorded or none.
+
+    Records are parsed, redacted and written by a writer thread. The loop only puts them in
+    a bounded queue and drops them when the writer falls behind. Segments are rotated after
+    `max_bytes` of JSON or `max_age` seconds and only get their final name once closed.
+    """
+
+    def __init__(self, directory: str, sample_rate: float = 1.0, compression: str = "gzip", redact: bool = True,
+        salt: str = "", max_bytes: int = 64 * 2**20, max_age: float = 3600, buffer_size: int = 10000,
+    ):
+        if compression == "zstd" and zstandard is None:
+            logger.warning("zstd recording requested but the `zstandard` package is not installed, using gzip")
+            compression = "gzip"
+        if compression not in SUFFIXES:
+            raise ValueError(f"Unknown compression {compression!r}, expected one of {', '.join(SUFFIXES)}")
+
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.compression = compression
+        self.redact = Redactor(salt) if redact else None
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=max(1, buffer_size))
+        self._thread: Optional[threading.Thread] = None
+        self._file: Optional[IO[bytes]] = None
+        self._raw: Optional[IO[bytes]] = None
+        self._path = ""
+        self._opened_at = 0.0
+        self._written = 0
+        self._segments = 0
+
+    def sampled(self, cid: str) -> bool:
+        if self.sample_rate >= 1:
+            return True
+        if cid == "-":  # not caused by a webhook event
+            return random.random() < self.sample_rate
+        return zlib.crc32(cid.encode()) % 1_000_000 < self.sample_rate * 1_000_000
+
+    def record_event(self, body: bytes):
+        cid = correlation_id.get()
+        if self.sampled(cid):
+            self._put("event", {"ts": time.time(), "kind": "event", "cid": cid}, body)
+
+    def record_call(self, method: str, path: str, status: int, duration: Optional[float], body: bytes):
+        cid = correlation_id.get()
+        if self.sampled(cid):
+            record = {"ts": time.time(), "kind": "call", "cid": cid, "method": method, "path": path, "status": status,
+                "duration": None if duration is None else round(duration, 6)}
+            self._put("call", record, body)
+
+    def _put(self, kind: str, record: Dict[str, Any], body: bytes):
+        try:
+            self._queue.put_nowait((record, body))
+        except queue.Full:
+            RECORDS.inc(kind=kind, outcome="dropped")
+
+    # Writer thread
+    async def start(self):
+        if self._thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name="recorder", daemon=True)
+            self._thread.start()
+
+    async def stop(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)  # waits for room, everything queued before it is written
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            if self._file and time.time() - self._opened_at >= self.max_age:
+                self._rotate()
+            if item is not None:
+                try:
+                    self._write(*item)
+                except Exception as e:
+                    RECORDS.inc(kind=item[0]["kind"], outcome="failed")
+                    logger.warning("Failed to record %s: %s", item[0]["kind"], e)
+        self._rotate()
+
+    def _write(self, record: Dict[str, Any], body: bytes):
+        payload: Any = None
+        if body:
+            try:
+                payload = loads(body)
+            except ValueError:
+                payload = body.decode("utf-8", "replace")
+        if self.redact:
+            payload = self.redact(payload)
+            if "path" in record:
+                record["path"] = self.redact(record["path"])
+        record["event" if record["kind"] == "event" else "request"] = payload
+
+        line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode()
+        if self._file is None:
+            self._open()
+        self._file.write(line)
+        self._written += len(line)
+        RECORDS.inc(kind=record["kind"], outcome="written")
+        if self._written >= self.max_bytes:
+            self._rotate()
+
+    def _open(self):
+        self._segments += 1
+        name = f"events-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._segments}{SUFFIXES[self.compression]}"
+        self._path = os.path.join(self.directory, name)
+        self._raw = raw = open(self._path + ".part", "wb")
+        if self.compression == "gzip":
+            self._file = gzip.GzipFile(fileobj=raw, mode="wb")
+        elif self.compression == "zstd":
+            self._file = zstandard.ZstdCompressor().stream_writer(raw)
+        else:
+            self._file = raw
+        self._opened_at = time.time()
+        self._written = 0
+
+    def _rotate(self):
+        if self._file is None:
+            return
+        self._file.close()
+        if not self._raw.closed:
+            self._raw.close()  # GzipFile doesn't close a file object it was given
+        os.replace(self._path + ".part", self._path)
+        self._file = None
+
+
+def open_recording(path: str) -> Iterator[str]:
+    """Lines of a recording segment, compressed or not."""
+    if path.endswith(".gz"):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            yield from f
+    elif path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("Reading .zst recordings needs the `zstandard` package")
+        with open(path, "rb") as raw, zstandard.ZstdDecompressor().stream_reader(raw) as reader:
+            yield from io.TextIOWrapper(reader, encoding="utf-8")
+    else:
+        with open(path, encoding="utf-8") as f:
+            yield from f
@@ -0,0 +1,156 @@
+from __future__ import annotations
+import asyncio
+import heapq
+from itertools import count
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from src.log import correlation_id, get_logger, with_correlation_id
+from src.ratelimit import PRIORITY_REPLY
+
+if TYPE_CHECKING:
+    from src.custom_client import WAHABot  # only for type checking
+
+logger = get_logger("send_scheduler")
+
+
+class _TypingWindow:
+    __slots__ = ("until", "pending", "typing", "tail", "begin")
+
+    def __init__(self):
+        self.until = 0.0  # loop time at which the last queued send of this chat fires
+        self.pending = 0
+        self.typing = False  # typing indicator was started and not stopped yet
+        self.tail: Optional[asyncio.Task] = None  # last send task, keeps sends of a chat in order
+        self.begin: Optional[asyncio.Task] = None  # last seen flush / start typing, sends wait for theirs
+
+
+class SendScheduler:
+    """
+    Fires the typing simulation of outbound messages from timers instead of sleeping.
+
+    Each pending send is one heap entry plus a future. A single loop timer is armed
+    for the earliest deadline and fires `_send_text` for every due entry.
+    Back-to-back sends to the same chat share one typing window: typing starts once,
+    each message is queued right after the previous one and typing stops before the last.
+    """
+
+    def __init__(self, bot: "WAHABot", max_delay: float = 60):
+        self.bot = bot
+        self.max_delay = max_delay
+        self._heap: List[Tuple[float, int, str, str, Optional[str], List[str], int, asyncio.Future, str, asyncio.Task]] = []
+        self._seq = count()
+        self._windows: Dict[str, _TypingWindow] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_at: Optional[float] = None
+        self._tasks = set()
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, chat_id: str, text: str, reply_to: Optional[str] = None, mentions: List[str] = [],
+        priority: int = PRIORITY_REPLY, typing: bool = True,
+    ) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        future = loop.create_future()
+        delay = min(self.bot._estimate_typing_seconds(text, mentions), self.max_delay) if typing else 0.0
+
+        window = self._windows.get(chat_id)
+        if window is None:
+            window = self._windows[chat_id] = _TypingWindow()
+        new_window = not window.pending
+        window.until = (now if new_window else max(now, window.until)) + delay
+        window.pending += 1
+        start_typing = typing and not window.typing
+        window.typing = window.typing or typing
+
+        # Begins of a chat run in order, a send waits for its own so typing and receipts never arrive after it
+        window.begin = begin = self._spawn(self._begin(chat_id, reply_to, start_typing, window.begin))
+        heapq.heappush(self._heap, (window.until, next(self._seq), chat_id, text, reply_to, mentions, priority, future, correlation_id.get(), begin))
+        self._arm(loop)
+        return future
+
+    async def flush(self):
+        """Send everything that is still waiting right away, used on shutdown."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = self._timer_at = None
+        while self._heap:
+            self._fire(heapq.heappop(self._heap))
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _arm(self, loop: asyncio.AbstractEventLoop):
+        if not self._heap:
+            return
+        deadline = self._heap[0][0]
+        if self._timer_at is not None and self._timer_at <= deadline:
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._timer_at = deadline
+        self._timer = loop.call_at(deadline, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = self._timer_at = None
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            self._fire(heapq.heappop(self._heap))
+        self._arm(loop)
+
+    def _fire(self, entry):
+        _, _, chat_id, text, reply_to, mentions, priority, future, cid, begin = entry
+        window = self._windows[chat_id]
+        window.pending -= 1
+        stop_typing = not window.pending and window.typing
+        if stop_typing:
+            window.typing = False
+        # Timer callbacks run outside the sender's context, restore its correlation id
+        deliver = self._deliver(chat_id, text, reply_to, mentions, priority, future, window.tail, begin, stop_typing)
+        window.tail = self._spawn(with_correlation_id(cid, deliver))
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _begin(self, chat_id: str, reply_to: Optional[str], start_typing: bool, previous: Optional[asyncio.Task]):
+        if previous:
+            await asyncio.gather(previous, return_exceptions=True)
+        await self.bot.mark_chat_as_seen(chat_id, reply_to)
+        if not start_typing:
+            return
+        try:
+            await self.bot.start_typing(chat_id)
+        except Exception as e:
+            logger.warning("Error handling `typing...` in %s: %s", chat_id, e)
+            # Allow to send without typing
+
+    async def _deliver(self, chat_id: str, text: str, reply_to: Optional[str], mentions: List[str], priority: int,
+        future: asyncio.Future, previous: Optional[asyncio.Task], begin: asyncio.Task, stop_typing: bool,
+    ):
+        if previous:
+            await asyncio.gather(previous, return_exceptions=True)
+        # WAHA may be slower than the typing delay, `typing` has to reach it before `paused` and the text
+        await asyncio.gather(begin, return_exceptions=True)
+
+        if stop_typing:
+            try:
+                await self.bot.stop_typing(chat_id)
+            except Exception as e:
+                logger.warning("Error pausing in %s", chat_id)
+
+        try:
+            result: Any = await self.bot._send_text(chat_id, text, reply_to, mentions, priority)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            window = self._windows.get(chat_id)
+            if window and not window.pending and window.tail is asyncio.current_task():
+                del self._windows[chat_id]
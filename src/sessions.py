@@ -0,0 +1,174 @@
+from __future__ import annotations
+import asyncio
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional
+
+from src.log import get_logger
+
+if TYPE_CHECKING:
+    from src.custom_client import WAHABot  # only for type checking
+
+logger = get_logger("sessions")
+
+# How often a worker checks whether another worker added or removed sessions
+SESSIONS_REFRESH = 1.0
+
+
+class SessionRegistry:
+    """
+    The WAHA sessions (WhatsApp numbers) one webhook serves, events are routed by their `session`.
+
+    Every session is a view of the bot (`WAHABot.for_session`) with its own name, `me`, pending
+    sends and read receipts. The HTTP pool, handlers, caches, dispatcher and limiter (which keeps
+    a bucket per session) are shared. The bot itself serves its own session and cannot be removed.
+    With shared state the list of added sessions lives there, so every worker picks up a change;
+    lookups never wait for it, a poll in the background applies the change for the next ones.
+    """
+
+    def __init__(self, bot: "WAHABot", refresh: float = SESSIONS_REFRESH, clock: Callable[[], float] = time.monotonic):
+        self.bot = bot
+        self.refresh = refresh
+        self._clock = clock
+        self._sessions: Dict[str, "WAHABot"] = {bot.session: bot}
+        self._version = 0
+        self._checked_at = 0.0
+        self._polling: Optional[asyncio.Task] = None
+        self._saving = 0  # a poll must not apply a list read before our own change was stored
+        self._tasks = set()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._sessions
+
+    def __iter__(self) -> Iterator["WAHABot"]:
+        return iter(list(self._sessions.values()))
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def names(self) -> List[str]:
+        self._refresh()
+        return list(self._sessions)
+
+    def get(self, name: str) -> Optional["WAHABot"]:
+        self._refresh()
+        return self._sessions.get(name)
+
+    def route(self, evt: Dict[str, Any]) -> Optional["WAHABot"]:
+        # Events without a session belong to the bot's own
+        session = self.get(evt.get("session") or self.bot.session)
+        if session is not None:
+            me = evt.get("me")
+            if me:
+                session.me = me
+            elif session.me:
+                evt["me"] = session.me  # e.g. events of engines that leave it out
+        return session
+
+    async def add(self, name: str) -> "WAHABot":
+        name = name.strip()
+        if not name:
+            raise ValueError("Session name cannot be empty")
+        session = self._sessions.get(name)
+        if session is None:
+            session = self._sessions[name] = self.bot.for_session(name)
+            logger.info("Serving session %s", name)
+        await self._save(added=name)
+        return session
+
+    async def remove(self, name: str) -> bool:
+        if name == self.bot.session:
+            raise ValueError(f"{name!r} is the bot's own session and cannot be removed")
+        session = self._sessions.pop(name, None)
+        if session is None:
+            return False
+        await self._save(removed=name)
+        await self._retire(session)
+        return True
+
+    async def _retire(self, session: "WAHABot"):
+        # Messages already scheduled still go out from the session they were meant for
+        await session.scheduler.flush()
+        await session.receipts.flush_all()
+        logger.info("Stopped serving session %s", session.session)
+
+    async def flush(self):
+        # Schedulers first, a send flushes its chat's receipts anyway
+        for session in self:
+            await session.scheduler.flush()
+        for session in self:
+            await session.receipts.flush_all()
+
+    async def _save(self, added: Optional[str] = None, removed: Optional[str] = None):
+        state = self.bot.state
+        if not state.shared:
+            return
+        # Applied to the stored list rather than ours, which may miss another worker's change
+        self._saving += 1
+        try:
+            stored = await state.aget("sessions", "names") or []
+            names = sorted((set(stored) | {added}) - {removed, None})
+            if names == sorted(stored):
+                return
+            await state.aset("sessions", "names", names)
+            version = await state.abump("sessions")
+        finally:
+            self._saving -= 1
+        if version != self._version + 1:
+            # Another worker changed the list too, reload on the next lookup
+            version = -1
+            self._checked_at = 0.0
+        self._version = version
+
+    def _refresh(self):
+        state = self.bot.state
+        if not state.shared or self._polling is not None:
+            return
+        now = self._clock()
+        if now - self._checked_at < self.refresh:
+            return
+        self._checked_at = now
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Not serving yet, nothing waits on this query
+            version = state.version("sessions")
+            if version != self._version:
+                self._apply(version, state.get("sessions", "names") or [])
+            return
+        self._polling = asyncio.ensure_future(self._poll())
+
+    async def _poll(self):
+        state = self.bot.state
+        ours = self._version
+        try:
+            version = await state.aversion("sessions")
+            if version != ours:
+                names = await state.aget("sessions", "names") or []
+                if self._version == ours and not self._saving:  # else we saved a change meanwhile, the next poll sees both
+                    self._apply(version, names)
+        except Exception as e:
+            logger.warning("Could not refresh sessions: %s", e)
+        finally:
+            self._polling = None
+
+    def _apply(self, version: int, stored: List[str]):
+        self._version = version
+        names = set(stored)
+        for name in names - set(self._sessions):
+            self._sessions[name] = self.bot.for_session(name)
+            logger.info("Serving session %s, added by another worker", name)
+        for name in set(self._sessions) - names - {self.bot.session}:
+            task = asyncio.ensure_future(self._retire(self._sessions.pop(name)))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> Dict[str, Any]:
+        self._refresh()
+        return {
+            session.session: {
+                "me": (session.me or {}).get("id"),
+                "pending_sends": session.scheduler.pending(),
+                "pending_receipts": session.receipts.pending(),
+            }
+            for session in self
+        }
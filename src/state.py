@@ -0,0 +1,212 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class _AsyncCalls:
+    """Awaitable variants of the calls made while serving events, a backend decides where they run."""
+
+    async def _offload(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return fn(*args)
+
+    async def aget(self, namespace: str, key: str, default: Any = None) -> Any:
+        return await self._offload(self.get, namespace, key, default)
+
+    async def aset(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await self._offload(self.set, namespace, key, value, ttl)
+
+    async def amark(self, namespace: str, key: str, ttl: float) -> bool:
+        return await self._offload(self.mark, namespace, key, ttl)
+
+    async def aunmark(self, namespace: str, key: str) -> None:
+        await self._offload(self.unmark, namespace, key)
+
+    async def aversion(self, name: str) -> int:
+        return await self._offload(self.version, name)
+
+    async def abump(self, name: str) -> int:
+        return await self._offload(self.bump, name)
+
+
+class MemoryState(_AsyncCalls):
+    """
+    State that only this process sees, the default for a single worker.
+
+    Values are namespaced key/value pairs with an optional TTL, markers are keys only the
+    first caller within their TTL gets to set (dedup, seen ids) and versions are counters
+    that tell other workers their copy of something is stale.
+    """
+
+    shared = False
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self._clock = clock
+        self._values: Dict[Tuple[str, str], Tuple[Optional[float], Any]] = {}
+        self._versions: Dict[str, int] = {}
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        entry = self._values.get((namespace, key))
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= self._clock():
+            del self._values[(namespace, key)]
+            return default
+        return value
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._values[(namespace, key)] = (None if ttl is None else self._clock() + ttl, value)
+
+    def delete(self, namespace: str, key: str) -> None:
+        self._values.pop((namespace, key), None)
+
+    def mark(self, namespace: str, key: str, ttl: float) -> bool:
+        if self.get(namespace, key) is not None:
+            return False
+        self.set(namespace, key, True, ttl)
+        return True
+
+    def unmark(self, namespace: str, key: str) -> None:
+        self.delete(namespace, key)
+
+    def version(self, name: str) -> int:
+        return self._versions.get(name, 0)
+
+    def bump(self, name: str) -> int:
+        self._versions[name] = self._versions.get(name, 0) + 1
+        return self._versions[name]
+
+    def purge(self) -> None:
+        now = self._clock()
+        for k in [k for k, (expires_at, _) in self._values.items() if expires_at is not None and expires_at <= now]:
+            del self._values[k]
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteState(_AsyncCalls):
+    """
+    The same state in a SQLite file (WAL), shared by every worker process that opens it.
+    Values are stored as JSON. Expired rows are purged at most every `purge_interval` seconds.
+
+    A write can wait up to 5s for another process's lock, so the `a*` variants run the query
+    on a thread of their own and the event loop keeps serving meanwhile.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, purge_interval: float = 60, clock: Callable[[], float] = time.time):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._clock = clock
+        self.purge_interval = purge_interval
+        self._purged_at = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")  # calls take the lock anyway
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS state_expires ON state (expires_at) WHERE expires_at IS NOT NULL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+    def _maybe_purge(self, now: float) -> None:
+        # Caller holds the lock
+        if now - self._purged_at >= self.purge_interval:
+            self._db.execute("DELETE FROM state WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+            self._purged_at = now
+
+    async def _offload(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (namespace, key, self._clock()),
+            ).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        now = self._clock()
+        with self._lock:
+            self._maybe_purge(now)
+            self._db.execute(
+                "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value), None if ttl is None else now + ttl),
+            )
+
+    def delete(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def mark(self, namespace: str, key: str, ttl: float) -> bool:
+        now = self._clock()
+        with self._lock:
+            self._maybe_purge(now)
+            # Inserts, or takes over a marker that expired, atomically across processes
+            cursor = self._db.execute(
+                "INSERT INTO state (namespace, key, value, expires_at) VALUES (?, ?, 'true', ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                "WHERE state.expires_at IS NOT NULL AND state.expires_at <= ?",
+                (namespace, key, now + ttl, now),
+            )
+            return cursor.rowcount == 1
+
+    def unmark(self, namespace: str, key: str) -> None:
+        self.delete(namespace, key)
+
+    def version(self, name: str) -> int:
+        with self._lock:
+            row = self._db.execute("SELECT version FROM versions WHERE name = ?", (name,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def bump(self, name: str) -> int:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "INSERT INTO versions (name, version) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET version = version + 1",
+                    (name,),
+                )
+                version = self._db.execute("SELECT version FROM versions WHERE name = ?", (name,)).fetchone()[0]
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return version
+
+    def purge(self) -> None:
+        with self._lock:
+            self._purged_at = 0.0
+            self._maybe_purge(self._clock())
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
+
+
+def state_backend(backend: str = "memory", path: str = ""):
+    if backend == "memory":
+        return MemoryState()
+    if backend == "sqlite":
+        if not path:
+            raise ValueError("SQLite state needs a path")
+        return SQLiteState(path)
+    raise ValueError(f"Unknown state backend {backend!r}")
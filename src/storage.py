@@ -1,50 +1,387 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sqlite3
+import threading
 import time
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
 
-_subscribers: Dict[str, Set[str]] = {}
-_history: Dict[str, List[Dict[str, Any]]] = {}
+from src.log import get_logger
+from src.state import MemoryState
+
+logger = get_logger("storage")
 
 MAX_BUFFER_SIZE = 50
+# How often a worker checks whether another worker changed the subscriptions
+SUBSCRIPTIONS_REFRESH = 1.0
+
+
+class MemoryHistory:
+    """Per-chat ring buffers, appends are O(1) and the oldest message falls off."""
+
+    persistent = False  # subscriptions are not saved, other workers cannot reload them from here
+    executor = None  # calls are cheap enough to run on the event loop
+
+    def __init__(self):
+        self._buffers: Dict[str, Deque[Dict[str, Any]]] = {}
+
+    def append(self, chat_id: str, record: Dict[str, Any], limit: int) -> None:
+        buf = self._buffers.get(chat_id)
+        if buf is None or buf.maxlen != limit:
+            buf = self._buffers[chat_id] = deque(buf or (), maxlen=limit)
+        buf.append(record)
+
+    def latest(self, chat_id: str, n: int) -> List[Dict[str, Any]]:
+        buf = self._buffers.get(chat_id)
+        if not buf or n <= 0:
+            return []
+        start = max(0, len(buf) - n)
+        return [buf[i] for i in range(start, len(buf))]
+
+    def range(self, chat_id: str, offset: int = 0, since: Optional[float] = None) -> List[Dict[str, Any]]:
+        buf = self._buffers.get(chat_id)
+        if not buf or offset >= len(buf):
+            return []
+        records = [buf[i] for i in range(max(0, offset), len(buf))]
+        if since is not None:
+            records = [r for r in records if r["timestamp"] >= since]
+        return records
+
+    def length(self, chat_id: str) -> int:
+        return len(self._buffers.get(chat_id, ()))
+
+    def drop(self, chat_id: str) -> None:
+        self._buffers.pop(chat_id, None)
+
+    def save_subscriptions(self, feature: str, chat_ids: List[str], retention: int) -> None:
+        pass  # subscriptions only live in the process
+
+    def delete_subscriptions(self, feature: str, chat_ids: List[str]) -> None:
+        pass
+
+    def load_subscriptions(self) -> List[Tuple[str, str, int]]:
+        return []
+
+
+class SQLiteHistory:
+    """
+    Durable history in a SQLite file, survives restarts and trims per chat on insert.
+
+    Other workers may hold the file's write lock for up to 5s, so the storage functions run
+    these calls on `executor`, one thread that also keeps each chat's writes in order.
+    """
+
+    persistent = True
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                text TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                timestamp REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS messages_chat_ts ON messages (chat_id, timestamp)")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                feature TEXT NOT NULL,
+                chat_id TEXT NOT NULL,
+                retention INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (feature, chat_id)
+            )
+        """)
+
+    def _rows(self, sql: str, params: tuple) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [{"sender": r["sender"], "text": r["text"], "message_id": r["message_id"], "timestamp": r["timestamp"]} for r in rows]
+
+    def append(self, chat_id: str, record: Dict[str, Any], limit: int) -> None:
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute(
+                    "INSERT INTO messages (chat_id, sender, text, message_id, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    (chat_id, record["sender"], record["text"], record["message_id"], record["timestamp"]),
+                )
+                self._db.execute("""
+                    DELETE FROM messages WHERE chat_id = ? AND id IN (
+                        SELECT id FROM messages WHERE chat_id = ? ORDER BY timestamp DESC, id DESC LIMIT -1 OFFSET ?
+                    )
+                """, (chat_id, chat_id, limit))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def latest(self, chat_id: str, n: int) -> List[Dict[str, Any]]:
+        if n <= 0:
+            return []
+        rows = self._rows(
+            "SELECT * FROM messages WHERE chat_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?", (chat_id, n)
+        )
+        rows.reverse()
+        return rows
+
+    def range(self, chat_id: str, offset: int = 0, since: Optional[float] = None) -> List[Dict[str, Any]]:
+        if since is None:
+            since = float("-inf")
+        return self._rows(
+            "SELECT * FROM messages WHERE chat_id = ? AND timestamp >= ? ORDER BY timestamp, id LIMIT -1 OFFSET ?",
+            (chat_id, since, max(0, offset)),
+        )
+
+    def length(self, chat_id: str) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+
+    def drop(self, chat_id: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+
+    def save_subscriptions(self, feature: str, chat_ids: List[str], retention: int) -> None:
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO subscriptions (feature, chat_id, retention) VALUES (?, ?, ?)",
+                [(feature, chat_id, retention) for chat_id in chat_ids],
+            )
+
+    def delete_subscriptions(self, feature: str, chat_ids: List[str]) -> None:
+        with self._lock:
+            self._db.executemany(
+                "DELETE FROM subscriptions WHERE feature = ? AND chat_id = ?",
+                [(feature, chat_id) for chat_id in chat_ids],
+            )
+
+    def load_subscriptions(self) -> List[Tuple[str, str, int]]:
+        with self._lock:
+            return [tuple(r) for r in self._db.execute("SELECT feature, chat_id, retention FROM subscriptions").fetchall()]
+
+
+_subscribers: Dict[str, Set[str]] = {}  # feature: chat ids
+_chat_features: Dict[str, Dict[str, int]] = {}  # chat_id: {feature: retention}, reverse index of _subscribers
+_chat_retention: Dict[str, int] = {}
+_history = MemoryHistory()
+_state = MemoryState()
+_subscriptions_version = 0
+_subscriptions_checked_at = 0.0
+_subscriptions_polling: Optional[asyncio.Task] = None
+_subscriptions_saving = 0  # a poll must not apply rows read before our own change was saved
+
+
+async def _offload(fn, *args: Any) -> Any:
+    executor = _history.executor
+    if executor is None:
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+def storage_configure(backend: str = "memory", path: str = "", state: Optional[Any] = None) -> None:
+    # With a shared `state` (and history), subscription changes made by other workers are picked up
+    global _history, _state
+    if backend == "memory":
+        _history = MemoryHistory()
+    elif backend == "sqlite":
+        if not path:
+            raise ValueError("SQLite storage needs a path")
+        _history = SQLiteHistory(path)
+    else:
+        raise ValueError(f"Unknown storage backend {backend!r}")
+    if state is not None:
+        _state = state
+    storage_restore_subscriptions()
+    # Subscriptions registered before configuring are persisted too, the backend is the source of truth from here on
+    for feature, chats in list(_subscribers.items()):
+        for chat_id in chats:
+            _history.save_subscriptions(feature, [chat_id], _chat_features[chat_id][feature])
+    if _syncs_subscriptions():
+        _subscriptions_bumped(_state.bump("subscriptions"))  # before serving, nothing waits on it
+
 
+def _syncs_subscriptions() -> bool:
+    # Reloading is only safe when the backend holds every subscription, a memory one would wipe them
+    return _state.shared and _history.persistent
 
-def storage_subscribe(feature: str, chat_id: str) -> None:
+
+async def _subscriptions_changed() -> None:
+    if _syncs_subscriptions():
+        _subscriptions_bumped(await _state.abump("subscriptions"))
+
+
+def _subscriptions_bumped(version: int) -> None:
+    global _subscriptions_version, _subscriptions_checked_at
+    if version == _subscriptions_version + 1:
+        _subscriptions_version = version
+    else:
+        _subscriptions_checked_at = 0.0  # another worker changed them in between, reload on the next lookup
+
+
+def _refresh_subscriptions() -> None:
+    # Lookups use the subscriptions they have, a background poll reloads them once another worker changed them
+    global _subscriptions_checked_at, _subscriptions_polling
+    if not _syncs_subscriptions() or _subscriptions_polling is not None:
+        return
+    now = time.monotonic()
+    if now - _subscriptions_checked_at < SUBSCRIPTIONS_REFRESH:
+        return
+    _subscriptions_checked_at = now
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # Not serving yet, nothing waits on these queries
+        version = _state.version("subscriptions")
+        if version != _subscriptions_version:
+            _reload_subscriptions(version, _history.load_subscriptions())
+        return
+    _subscriptions_polling = asyncio.ensure_future(_poll_subscriptions())
+
+
+async def _poll_subscriptions() -> None:
+    global _subscriptions_polling
+    ours = _subscriptions_version
+    try:
+        version = await _state.aversion("subscriptions")
+        if version != ours:
+            rows = await asyncio.get_running_loop().run_in_executor(None, _history.load_subscriptions)
+            if _subscriptions_version == ours and not _subscriptions_saving:  # else this worker changed them meanwhile, the next poll sees both
+                _reload_subscriptions(version, rows)
+    except Exception as e:
+        logger.warning("Could not refresh subscriptions: %s", e)
+    finally:
+        _subscriptions_polling = None
+
+
+def _reload_subscriptions(version: int, rows: Iterable[Tuple[str, str, int]]) -> None:
+    global _subscriptions_version
+    _subscriptions_version = version
+    _subscribers.clear()
+    _chat_features.clear()
+    _chat_retention.clear()
+    for feature, chat_id, retention in rows:
+        _add_subscription(feature, chat_id, retention)
+
+
+def storage_restore_subscriptions() -> None:
+    # Merges persisted subscriptions into the ones registered so far
+    for feature, chat_id, retention in _history.load_subscriptions():
+        _add_subscription(feature, chat_id, retention)
+
+
+def _add_subscription(feature: str, chat_id: str, retention: int) -> None:
     _subscribers.setdefault(feature, set()).add(chat_id)
+    features = _chat_features.setdefault(chat_id, {})
+    features[feature] = retention
+    _chat_retention[chat_id] = max(r or MAX_BUFFER_SIZE for r in features.values())
 
 
-def storage_unsubscribe(feature: str, chat_id: str) -> None:
-    if feature in _subscribers:
-        _subscribers[feature].discard(chat_id)
-    if not storage_is_enabled(chat_id):
-        _history.pop(chat_id, None)
+def _remove_subscription(feature: str, chat_id: str) -> bool:
+    chats = _subscribers.get(feature)
+    if chats is not None:
+        chats.discard(chat_id)
+        if not chats:
+            del _subscribers[feature]
+
+    features = _chat_features.get(chat_id)
+    if features is None:
+        return False
+    features.pop(feature, None)
+    if features:
+        _chat_retention[chat_id] = max(r or MAX_BUFFER_SIZE for r in features.values())
+        return False
+
+    # Last feature of the chat is gone
+    del _chat_features[chat_id]
+    _chat_retention.pop(chat_id, None)
+    return True
+
+
+async def storage_subscribe(feature: str, chat_id: str, retention: Optional[int] = None) -> None:
+    await storage_subscribe_many(feature, [chat_id], retention)
+
+
+async def storage_subscribe_many(feature: str, chat_ids: Iterable[str], retention: Optional[int] = None) -> None:
+    # Applied here right away, saved and announced to other workers off the event loop
+    global _subscriptions_saving
+    chat_ids = list(chat_ids)
+    for chat_id in chat_ids:
+        _add_subscription(feature, chat_id, retention or 0)
+    _subscriptions_saving += 1
+    try:
+        await _offload(_history.save_subscriptions, feature, chat_ids, retention or 0)
+        await _subscriptions_changed()
+    finally:
+        _subscriptions_saving -= 1
+
+
+async def storage_unsubscribe(feature: str, chat_id: str) -> None:
+    await storage_unsubscribe_many(feature, [chat_id])
+
+
+async def storage_unsubscribe_many(feature: str, chat_ids: Iterable[str]) -> None:
+    global _subscriptions_saving
+    chat_ids = list(chat_ids)
+    dropped = [chat_id for chat_id in chat_ids if _remove_subscription(feature, chat_id)]
+    _subscriptions_saving += 1
+    try:
+        for chat_id in dropped:
+            await _offload(_history.drop, chat_id)
+        await _offload(_history.delete_subscriptions, feature, chat_ids)
+        await _subscriptions_changed()
+    finally:
+        _subscriptions_saving -= 1
 
 
 def storage_is_enabled(chat_id: str) -> bool:
-    return any(chat_id in s for s in _subscribers.values())
+    _refresh_subscriptions()
+    return chat_id in _chat_features
+
+
+def storage_get_features(chat_id: str) -> Set[str]:
+    _refresh_subscriptions()
+    return set(_chat_features.get(chat_id, ()))
+
 
+def storage_get_retention(chat_id: str) -> int:
+    _refresh_subscriptions()
+    # The chat keeps as much as its most demanding subscribed feature asks for
+    return _chat_retention.get(chat_id, MAX_BUFFER_SIZE)
 
-def storage_capture(chat_id: str, sender: str, text: str, message_id: str, timestamp: Optional[float] = None) -> None:
+
+async def storage_capture(chat_id: str, sender: str, text: str, message_id: str, timestamp: Optional[float] = None) -> None:
     if not storage_is_enabled(chat_id):
         return
-    buf = _history.setdefault(chat_id, [])
-    buf.append({
+    await _offload(_history.append, chat_id, {
         "sender": sender,
         "text": text,
         "message_id": message_id,
         "timestamp": timestamp or time.time(),
-    })
-    buf[:] = buf[-MAX_BUFFER_SIZE:]
+    }, _chat_retention[chat_id])
 
 
-def storage_get_messages(chat_id: str, n: int = 20) -> List[Dict[str, Any]]:
-    return _history.get(chat_id, [])[-n:]
+async def storage_get_messages(chat_id: str, n: int = 20) -> List[Dict[str, Any]]:
+    return await _offload(_history.latest, chat_id, n)
 
 
-def storage_get_length(chat_id: str) -> int:
-    return len(_history.get(chat_id, []))
+async def storage_get_length(chat_id: str) -> int:
+    return await _offload(_history.length, chat_id)
 
 
-def storage_get_since(chat_id: str, index: int) -> List[Dict[str, Any]]:
-    buf = _history.get(chat_id, [])
-    if index >= len(buf):
-        return []
-    return buf[index:]
+async def storage_get_since(chat_id: str, index: int) -> List[Dict[str, Any]]:
+    return await _offload(_history.range, chat_id, index)
+
+
+async def storage_get_since_time(chat_id: str, timestamp: float) -> List[Dict[str, Any]]:
+    return await _offload(_history.range, chat_id, 0, timestamp)
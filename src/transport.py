@@ -0,0 +1,198 @@
+import asyncio
+from fnmatch import fnmatchcase
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from src.log import get_logger
+from src.metrics import REGISTRY
+
+logger = get_logger("transport")
+
+RETRIES = REGISTRY.counter("wahabot_waha_retries_total", "WAHA calls retried, or not retried because the budget ran out", ["outcome"])
+BREAKER_REJECTED = REGISTRY.counter("wahabot_waha_breaker_rejected_total", "WAHA calls failed fast by the circuit breaker")
+
+RETRY_STATUSES = {429, 502, 503, 504}
+# WAHA refused the request without acting on it, safe to retry any method
+_REFUSED_STATUSES = {429, 503}
+# The request never reached WAHA, safe to retry any method
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+_IDEMPOTENT = {"GET", "HEAD", "OPTIONS", "DELETE", "PUT"}
+
+
+class CircuitOpenError(httpx.HTTPError):
+    def __init__(self, retry_in: float):
+        super().__init__(f"WAHA circuit is open, retrying in {retry_in:.1f}s")
+        self.retry_in = retry_in
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of regular traffic so they can't multiply an outage.
+
+    Each first attempt deposits `ratio` tokens (up to `max_tokens`), each retry spends one.
+    `min_tokens` is the floor that lets a quiet bot still retry a few times.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_tokens: float = 3, max_tokens: float = 20):
+        self.ratio = ratio
+        self.min_tokens = min_tokens
+        self.max_tokens = max(max_tokens, min_tokens)
+        self._tokens = min_tokens
+
+    def deposit(self):
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class CircuitBreaker:
+    """
+    closed: calls go through, `threshold` consecutive failures open the circuit.
+    open: calls fail fast with CircuitOpenError for `reset_timeout` seconds.
+    half-open: a single probe call goes through, its result closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 10, clock: Callable[[], float] = time.monotonic):
+        self.threshold = max(1, threshold)
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        state = self.state
+        if state == "closed":
+            return
+        if state == "open" or self._probing:
+            BREAKER_REJECTED.inc()
+            raise CircuitOpenError(max(0.0, self.reset_timeout - (self._clock() - self._opened_at)))
+        self._probing = True  # half open, this call is the probe
+
+    def record_success(self):
+        if self._opened_at is not None:
+            logger.info("WAHA is reachable again, closing circuit")
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def abandon(self):
+        # The call was cancelled before it could tell us anything
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._probing or (self._opened_at is None and self._failures >= self.threshold):
+            logger.warning("Opening WAHA circuit after %d failures", self._failures)
+            self._opened_at = self._clock()
+        self._probing = False
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, retries are bounded by `attempts` and the shared budget."""
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.2, max_delay: float = 5, budget: Optional[RetryBudget] = None):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def should_retry(self, method: str, error: Optional[Exception] = None, status: Optional[int] = None) -> bool:
+        if error is not None:
+            if isinstance(error, CircuitOpenError):
+                return False
+            if isinstance(error, _NOT_SENT):
+                return True
+            return method in _IDEMPOTENT and isinstance(error, (httpx.TimeoutException, httpx.RemoteProtocolError, httpx.ReadError))
+        # A 502/504 may come after WAHA already sent the message, only repeat calls that can be repeated
+        return status in (RETRY_STATUSES if method in _IDEMPOTENT else _REFUSED_STATUSES)
+
+
+class RequestPolicy:
+    """Applies per-endpoint timeouts, the circuit breaker and retries to one WAHA call."""
+
+    def __init__(self, retry: Optional[RetryPolicy] = None, breaker: Optional[CircuitBreaker] = None,
+        timeouts: Optional[Dict[str, float]] = None,
+    ):
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self.timeouts = timeouts or {}  # fnmatch pattern on the path: seconds
+
+        REGISTRY.gauge("wahabot_waha_circuit_open", "1 while the WAHA circuit breaker is open or probing",
+            fn=lambda: {(): 0 if self.breaker.state == "closed" else 1})
+
+    def timeout_for(self, path: str) -> Optional[float]:
+        for pattern, timeout in self.timeouts.items():
+            if fnmatchcase(path, pattern):
+                return timeout
+        return None
+
+    async def run(self, method: str, path: str, send: Callable[[Optional[float]], Awaitable[httpx.Response]]) -> httpx.Response:
+        method = method.upper()
+        timeout = self.timeout_for(path)
+        self.retry.budget.deposit()
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            error: Optional[Exception] = None
+            response: Optional[httpx.Response] = None
+            try:
+                response = await send(timeout)
+            except httpx.HTTPError as e:
+                error = e
+            except BaseException:
+                self.breaker.abandon()
+                raise
+
+            failed = error is not None or response.status_code >= 500
+            if failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+            status = response.status_code if response is not None else None
+            retryable = (error is not None or status in RETRY_STATUSES) and self.retry.should_retry(method, error, status)
+            attempt += 1
+            if not retryable or attempt >= self.retry.attempts:
+                if error is not None:
+                    raise error
+                return response
+
+            if not self.retry.budget.withdraw():
+                RETRIES.inc(outcome="budget_exhausted")
+                if error is not None:
+                    raise error
+                return response
+
+            RETRIES.inc(outcome="retried")
+            delay = self.retry.backoff(attempt)
+            logger.info("Retrying %s %s in %.2fs (attempt %d): %s", method, path, delay, attempt + 1, error or status)
+            if response is not None:
+                await response.aclose()
+            await asyncio.sleep(delay)
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
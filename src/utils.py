@@ -6,20 +6,13 @@ if TYPE_CHECKING:
 
 import re
 
-WA_DOMAINS = ["c.us", "lid", "s.whatsapp.net"]
-DOMAINS_RE = "|".join(re.escape(d) for d in WA_DOMAINS)
-MENTIONS_RE = re.compile(rf"@(\d+)@({DOMAINS_RE})")
-MENTIONS_RECV_RE = re.compile(r"@(\d+)")
+from src.log import get_logger
+from src.mentions import DOMAINS_RE, WA_DOMAINS, MentionEngine, MentionScan, cleanup_label
 
-def cleanup_label(my_label_raw):
-    if my_label_raw:
-        _l_i, _l_r = my_label_raw.split("@", 1)
-        _l_i = _l_i.split(":", 1)[0]
-        my_label = f"{_l_i.strip()}@{_l_r.strip()}"
-    else:
-        my_label = ""
-    return my_label
+logger = get_logger("utils")
 
+MENTIONS_RE = re.compile(rf"@(\d+)@({DOMAINS_RE})")
+MENTIONS_RECV_RE = re.compile(r"@(\d+)")
 
 def is_me(target_id: str, me: dict) -> bool:
     if not me:
@@ -36,6 +29,8 @@ def is_target(target_id: Optional[str], my_id: str, my_jid: str, my_label: str)
 async def get_mentions_list(client: "WAHABot", chat_id, me={}, admins_only=True):
     messages = []
     group_members = await client.get_group_members(chat_id)
+    # Parsed identities carry their precomputed sets, a plain `me` dict is turned into them once per call
+    engine = getattr(me, "mentions", None) or (MentionEngine.for_me(me) if me else None)
     for member in group_members:
         target_id = member.get("lid") or member.get("id") or member.get("jid") # id is either jid or lid or c.us id. jid is <phone>@s.whatsapp.net. lid is <label>@lid. c.us is <phone>@c.us
         admin_type = member.get("admin", None)
@@ -45,8 +40,8 @@ async def get_mentions_list(client: "WAHABot", chat_id, me={}, admins_only=True)
         if admins_only and not admin_type:
             continue
 
-        if me and is_me(target_id, me):
-            print("Not mentioning self!")
+        if engine and engine.is_me(target_id):
+            logger.debug("Not mentioning self!")
             continue
 
         # TODO: Support removing the requestor by passing # Edit: Not possible cuz sender is c.us but group people are s.whatsapp.net
@@ -55,17 +50,10 @@ async def get_mentions_list(client: "WAHABot", chat_id, me={}, admins_only=True)
     return messages
 
 def parse_mentions_for_sending(text):
-    matches = MENTIONS_RE.findall(text)
-    mentions = list(set([f"{m[0]}@{m[1]}" for m in matches]))
-
-    text = MENTIONS_RE.sub(r"@\1", text)
-
-    return text, mentions
+    return MentionScan(text).for_sending()
 
 def get_mentions(text):
-    matches = MENTIONS_RECV_RE.findall(text)
-    mentions = list(set(matches))
-    return mentions
+    return list(MentionScan(text).ids)
 
 def is_mention(text):
     return bool(MENTIONS_RE.match(text))
@@ -74,8 +62,6 @@ def has_mentions(text):
     return bool(parse_mentions_for_sending(text)[1])
 
 def is_mentioned(text, user):
-    suffixes = ("@c.us", "@lid", "@s.whatsapp.net")
-    mentions = {m + s for m in get_mentions(text) for s in suffixes}
-    return any(
-        u and u in mentions for u in (user.get("id"), user.get("jid"), cleanup_label(user.get("lid")))
-    )
+    # Parsed identities keep their engine, see src/mentions.py
+    engine = getattr(user, "mentions", None) or MentionEngine.for_me(user)
+    return engine.mentions_me(text)
@@ -1,19 +1,24 @@
+import logging
 import re
-import string
+import time
 from typing import List, Optional, Tuple
 from fastapi import Request
 from fastapi.responses import JSONResponse
 
+from src.command_index import clean_token
 from src.custom_client import WAHABot
+from src.events import INVALID_KEYS, NO_BODY_KEYS, GroupEvent, MessageEvent, SessionEvent, identity, make_reply_id
+from src.metrics import EVENT_LATENCY, EVENTS, HANDLER_LATENCY, IN_FLIGHT, PARSE_LATENCY, WEBHOOK_LATENCY
+from src.log import EVENTS_LOGGER_NAME, correlation_id, get_logger, new_correlation_id, with_correlation_id
+from src.prefilter import SUPPORTED_EVENTS, loads
+from src.ratelimit import PRIORITY_ADMIN
 from src.storage import storage_capture
-from src.utils import cleanup_label, is_mention, is_mentioned, is_me, is_target
+from src.utils import is_mention
 
-_PUNCT_EXCEPT_AT = "".join(ch for ch in string.punctuation if ch != "@")
-# _MENTIONS_RE = re.compile(r"(?:@\d+@c\.us|@(all|everyone)\b)") # TODO: Remove @ all/everyone and instead change the command from on_mention to on # TODO 2: Update the function to use the better METIONS_RE
+logger = get_logger("webhook")
+events = logging.getLogger(EVENTS_LOGGER_NAME)
 
-def clean_token(tok: str) -> str:
-    tok = tok.strip()
-    return tok.translate(str.maketrans("", "", _PUNCT_EXCEPT_AT))
+# _MENTIONS_RE = re.compile(r"(?:@\d+@c\.us|@(all|everyone)\b)") # TODO: Remove @ all/everyone and instead change the command from on_mention to on # TODO 2: Update the function to use the better METIONS_RE
 
 def normalize(tok: str) -> str:
     return tok.strip().lower()
@@ -44,181 +49,210 @@ def parse_command(text: str) -> Tuple[str, List[str], List[str]]:
 
     return cmd, list(args), list(dict.fromkeys(mentions))
 
-def make_reply_id(message_id: str, chat_id: str, participant: str, is_sender_me: Optional[bool] = None, me: dict = {}):
-    is_sender_me = is_sender_me if is_sender_me is not None else is_me(participant, me)
-    
-    reply_id = f"{str(is_sender_me).lower()}_{chat_id}_{message_id}_{participant}"
-    
-    return reply_id
-
-
 def parse_message_event(event: dict):
     event_type = event.get("event")
     if not event_type:
-        print("No event")
+        logger.debug("No event")
         return {}
 
     if event_type == "session.status":
         status = event.get("payload", {}).get("status")
         if not status:
-            print("Invalid Status")
+            logger.warning("Invalid Status")
             return {}
-        print(f"Session", status)
-        return {
-            "type": "session",
-            "mode": status,  # starting, scan_qr_code, working, stopped - all uppercase
-        }
+        logger.info("Session %s", status)
+        return SessionEvent(status, event.get("session"))
+
+    if event_type == "group.v2.participants":
+        payload = event.get("payload", {})
+        group_id = (payload.get("group") or {}).get("id")
+        if not group_id:
+            logger.warning("Group participants event without group id")
+            return {}
+
+        participants = []
+        for participant in payload.get("participants") or []:
+            role = participant.get("role")
+            participants.append({
+                "id": participant.get("id"),
+                "admin": role if role in ("admin", "superadmin") else None,
+            })
+
+        return GroupEvent(group_id, payload.get("type"), participants)
+
+    if event_type in ("group.v2.join", "group.v2.leave", "group.v2.update", "group.join", "group.leave"):
+        payload = event.get("payload", {})
+        group = payload.get("group") or payload
+        group_id = group.get("id") if isinstance(group, dict) else None
+        if isinstance(group_id, dict):  # legacy events carry the serialized id
+            group_id = group_id.get("_serialized")
+        return GroupEvent(group_id, event_type.rsplit(".", 1)[-1], [])
 
     if event_type in ["message"]:  # message.* also uses same dict
         payload = event.get("payload", {})
         message_id = payload.get("id")
         chat_id: str = payload.get("from")
+        engine_data = payload.get("_data", {}) if payload else {}
 
-        me = event.get("me", {})
-        my_id = me.get("id")
-        my_jid = me.get("jid")
+        # Parsed once per session, the same for every event until it is paired again
+        me = identity(event.get("session") or "", event.get("me") or {})
 
-        my_label = cleanup_label(me.get("lid"))
-
-        if not my_id or not my_label or not payload:
-            print("Message received but my info is invalid!")
-            return {
-                "chat_id": chat_id,
-                "reply_id": message_id,
-                "should_reply": False,
-            }
-
-        engine_data = payload.get("_data", {})
+        if not me.id or not me.lid or not payload:
+            logger.warning("Message received but my info is invalid!")
+            return MessageEvent(event, payload or {}, engine_data, chat_id, message_id, keys=INVALID_KEYS)
 
         if engine_data.get("status") == "DELIVERY_ACK":
-            print("Message type is DELIVERY_ACK so skip")
+            events.debug("Message type is DELIVERY_ACK so skip")
             return {}
 
         reply_id: str = message_id
         chat_type = chat_id.rsplit("@", 1)[-1].strip()[0].lower()
 
+        key = engine_data.get("key", {})
         from_me = False
-        if chat_id == my_id:
+        if chat_id == me.id:
             from_me = True
-        elif engine_data.get("key", {}).get("senderLid") == my_label:
+        elif key.get("senderLid") == me.lid:
             from_me = True
-        elif engine_data.get("key", {}).get("participant") == my_label:
+        elif key.get("participant") == me.lid:
             from_me = True
         elif str(payload.get("fromMe", "")).lower() == "true":
             from_me = True
-        elif engine_data.get("key", {}).get(
-            "participantPn"
-        ):  # This line is kept for clarity, not needed
+        elif key.get("participantPn"):  # This line is kept for clarity, not needed
             from_me = False  # If not me then it has participant pn
 
         if from_me:
-            print(f"Skipping message from me in {chat_type}")
+            events.debug("Skipping message from me in %s", chat_type)
             return {}
 
-        message_stickers = engine_data.get("message", {}).get("stickerMessage", {})
-        if message_stickers:
-            sticker_hash = message_stickers.get("fileSha256", "")
-            sticker_key = message_stickers.get("mediaKey", "")
-            sticker_data = {
-                "hash": sticker_hash,
-                "key": sticker_key,
-            }
-        else:
-            sticker_data = {}
-
         message: str = payload.get("body") or "" # may be None 
         if not message.strip():
-            print(f"Received message in {chat_type} with no body")
-            return {
-                "chat_id": chat_id,
-                "reply_id": message_id,
-                "should_reply": False,
-                "media": {
-                    "sticker": sticker_data,
-                }
-            }
+            events.debug("Received message in %s with no body", chat_type)
+            # Sticker data is read from the event when a handler looks at `media`
+            return MessageEvent(event, payload, engine_data, chat_id, message_id, me, keys=NO_BODY_KEYS)
 
         if chat_type == "g":  # group
             if chat_id != payload.get("to"):  # duplicate message, unsure why!
-                print(f"Received duplicate message in {chat_type}, unsure how to parse")
+                events.debug("Received duplicate message in %s, unsure how to parse", chat_type)
                 return {}
-            sender_id = (
-                engine_data.get("key", {}).get("participantPn", "").split("@", 1)[0]
-                + "@c.us"
-            )
+            sender_id = key.get("participantPn", "").split("@", 1)[0] + "@c.us"
             sender_label = payload.get("participant")
         else:
             sender_id = chat_id
-            sender_label = engine_data.get("key", {}).get("senderLid")
-
-        print(f"Received message in {chat_type} from {sender_id} - {sender_label}")
-
-        mentions_me = is_mentioned(message, me)
-        reply_to = payload.get("replyTo") or {}
-        reply_to_participant = reply_to.get("participant")
-        reply_to_me = is_target(reply_to_participant, my_id, my_jid, my_label)
-        reply_to_body = reply_to.get("body")
-
-        reply_to_id = None
-        if reply_to:
-            reply_mid = reply_to.get("id", "")
-            reply_part = reply_to.get("participant", "")
-            reply_to_id = make_reply_id(reply_mid, chat_id, reply_part, is_target(reply_part, my_id, my_jid, my_label))
-
-        return {
-            "is_group": chat_type == "g",
-            "is_chat": chat_type == "c",
-            "sender": sender_id,
-            "sender_label": sender_label,
-            "chat_id": chat_id,
-            "reply_id": reply_id,
-            "should_reply": True,
-            "text": message,
-            "is_mentioned": mentions_me,
-            "is_reply": reply_to_me,
-            "reply_history": reply_to_body,
-            "reply_history_id": reply_to_id,
-            "me": {
-                "id": my_id,
-                "jid": my_jid,
-                "lid": my_label
-            },
-            "media": {
-                "sticker": sticker_data
-            }
-        }
+            sender_label = key.get("senderLid")
+
+        events.info("Received message in %s from %s - %s", chat_type, sender_id, sender_label)
+
+        # Whether the bot is mentioned, the reply context and media are worked out on first access
+        return MessageEvent(event, payload, engine_data, chat_id, reply_id, me, should_reply=True, text=message,
+            sender=sender_id, sender_label=sender_label)
     else:
         raise NotImplementedError(f"{event_type=} is not yet supported!")
 
+def event_label(client: WAHABot, evt) -> str:
+    # The type comes from the request body, types we don't know share one series so labels stay bounded
+    event_type = evt.get("event") if isinstance(evt, dict) else None
+    if isinstance(event_type, str) and (event_type in SUPPORTED_EVENTS or event_type in client.IGNORE_MESSAGES_SET):
+        return event_type
+    return "other"
+
 async def webhook(client: WAHABot, request: Request) -> JSONResponse:
-    evt = await request.json()
-    if evt.get("event") in client.IGNORE_MESSAGES_SET:
+    received_at = time.perf_counter()
+    IN_FLIGHT.inc()
+    try:
+        return await _webhook(client, request, received_at)
+    finally:
+        IN_FLIGHT.dec()
+        WEBHOOK_LATENCY.observe(time.perf_counter() - received_at)
+
+async def _webhook(client: WAHABot, request: Request, received_at: float) -> JSONResponse:
+    new_correlation_id()
+    body = await request.body()
+    if client.recorder:
+        client.recorder.record_event(body)
+    evt = loads(body)
+    event_type = event_label(client, evt)
+    if isinstance(evt, dict):
+        # The view of the event's session, with its own identity, pending sends and receipts
+        session = client.sessions.route(evt)
+        if session is None:
+            EVENTS.inc(event=event_type, outcome="ignored_session")
+            return JSONResponse({"status": "ignored", "reason": "session"})
+        client = session
+    if client.prefilter:
+        reason = client.prefilter.check(evt, client)
+        if reason:
+            EVENTS.inc(event=event_type, outcome=f"ignored_{reason}")
+            return JSONResponse({"status": "ignored", "reason": reason})
+    elif not isinstance(evt, dict) or not isinstance(evt.get("event") or "", str):
+        # Valid JSON but not a WAHA event, what the prefilter answers with `malformed`
+        EVENTS.inc(event=event_type, outcome="ignored_malformed")
+        return JSONResponse({"status": "ignored", "reason": "malformed"})
+    elif evt.get("event") in client.IGNORE_MESSAGES_SET:
+        EVENTS.inc(event=event_type, outcome="ignored")
         return JSONResponse({"status": "ignored"})
 
+    if client.dedup and await client.dedup.is_duplicate(evt):
+        # WAHA redelivers on timeouts, answer so it stops without running handlers again
+        EVENTS.inc(event=event_type, outcome="duplicate")
+        return JSONResponse({"status": "duplicate"})
+
+    parse_start = time.perf_counter()
     parsed_message = parse_message_event(event=evt)
-    print(f"Parsed event: {parsed_message}")
+    PARSE_LATENCY.observe(time.perf_counter() - parse_start)
+    events.debug("Parsed event: %s", parsed_message)  # only formatted when debug is on
+
+    if client.dispatcher is None:
+        return JSONResponse(await handle_event(client, evt, parsed_message, received_at))
+
+    status = client.dispatcher.submit(
+        lambda cid=correlation_id.get(): with_correlation_id(cid, handle_event(client, evt, parsed_message, received_at)),
+        key=parsed_message.get("chat_id"),  # per-chat ordering, chats run in parallel
+    )
+    if status != "queued":
+        EVENTS.inc(event=event_type, outcome=status)
+    if status == "rejected":
+        if client.dedup:
+            await client.dedup.forget(evt)
+        return JSONResponse({"status": status}, status_code=429)
+    return JSONResponse({"status": status})
+
+async def handle_event(client: WAHABot, evt: dict, parsed_message: dict, received_at: Optional[float] = None) -> dict:
+    event_type = event_label(client, evt)
+    outcome = "error"
+    try:
+        result = await _handle_event(client, evt, parsed_message)
+        outcome = "handled"
+        return result
+    finally:
+        EVENTS.inc(event=event_type, outcome=outcome)
+        if received_at is not None:
+            EVENT_LATENCY.observe(time.perf_counter() - received_at, event=event_type)
+
+async def _run_handler(label: str, handler, **kwargs):
+    start = time.perf_counter()
+    try:
+        return await handler(**kwargs)
+    finally:
+        HANDLER_LATENCY.observe(time.perf_counter() - start, command=label)
+
+async def _handle_event(client: WAHABot, evt: dict, parsed_message: dict) -> dict:
+    if parsed_message.get("type") == "group":
+        chat_id = parsed_message.get("chat_id")
+        if chat_id:
+            await client.apply_group_event(chat_id, parsed_message.get("action", ""), parsed_message.get("participants", []))
+        return {"ok": True}
+
     text = parsed_message.get("text", "") # should not be possible cuz empty text is always should_reply = False
     chat_id = parsed_message.get("chat_id")
     reply_id = parsed_message.get("reply_id")
     should_reply = parsed_message.get("should_reply", False)
-    mentions_me = parsed_message.get("is_mentioned", False)
     media = parsed_message.get("media", {})
     if reply_id and chat_id: # Reply id is simply message_id
-        try:
-            await client.mark_seen(chat_id, reply_id)
-        except Exception:
-            pass
-    # if reply_id and chat_id:
-    #     print(f"Setting {chat_id} seen marker to {reply_id}")
-    #     client.MESSAGES_HISTORY.setdefault(chat_id, []).append(reply_id)
-    #     if len(client.MESSAGES_HISTORY[chat_id]) > 10:
-    #         try:
-    #             await client.mark_chat_as_seen(chat_id)
-    #         except Exception:
-    #             pass
+        client.receipts.add(chat_id, reply_id)  # batched, flushed by size, time or the next send
     if parsed_message.get("type") == "session":
+        status = parsed_message.get("mode")
         if client.admins:
-            status = parsed_message.get("mode")
             for admin in client.admins:
                 send_to = admin
                 if '@' not in send_to:
@@ -226,9 +260,11 @@ async def webhook(client: WAHABot, request: Request) -> JSONResponse:
                 else:
                     send_to = send_to.strip()
                 try:
-                    await client.send(send_to, f"Whatsapp Bot Status: {status}")
+                    # From the bot's own session, the one whose status changed may not be able to send
+                    label = f" ({client.session})" if len(client.sessions) > 1 else ""
+                    client.sessions.bot.send_later(send_to, f"Whatsapp Bot Status{label}: {status}", priority=PRIORITY_ADMIN)
                 except Exception as e:
-                    print(f"Failed to notify admin {admin} for {e}")
+                    logger.warning("Failed to notify admin %s for %s", admin, e)
                     continue
         for handler in client._status_handlers:
             handler(
@@ -257,10 +293,12 @@ async def webhook(client: WAHABot, request: Request) -> JSONResponse:
                 handler_key = "all"
 
             handler = stickers_dict.get(handler_key)  # disallow "" key
-            print(f"Handling sticker media {handler_key} with handler {handler}")
+            events.debug("Handling sticker media %s with handler %s", handler_key, handler)
             if handler:
                 try:
-                    await handler(
+                    await _run_handler(
+                        "<sticker>",
+                        handler,
                         client=client,
                         chat_id=chat_id,
                         message_id=reply_id,
@@ -269,43 +307,49 @@ async def webhook(client: WAHABot, request: Request) -> JSONResponse:
                         parsed=parsed_message,
                     )
                 except Exception as e:
-                    print(f"{handler=} failed with {e}")
+                    logger.exception("%s failed with %s", handler, e)
 
     if not should_reply:
-        return JSONResponse({"ok": False})
+        return {"ok": False}
 
     sender = parsed_message.get("sender", "")
-    push_name = evt.get("payload", {}).get("_data", {}).get("pushName") or sender
-    storage_capture(chat_id, push_name or "", text or "", reply_id or "")
+    await storage_capture(chat_id, parsed_message.push_name or sender or "", text or "", reply_id or "")
 
-    cmd, args, mentions = parse_command(text)
-    handler = client._handlers.get(cmd.lower())
+    match = client.commands.match(text)  # same cmd/args/mentions as parse_command, args and mentions are lazy
+    cmd, handler = match.cmd, match.handler
     mentions_handlers = []
-    for mention in mentions:
-        m_h = client._mentions_handlers.get(mention)
-        if m_h:
-            mentions_handlers.append(m_h)
+    if client._mentions_handlers:
+        for mention in match.mentions:
+            m_h = client._mentions_handlers.get(mention)
+            if m_h:
+                mentions_handlers.append((mention, m_h))
 
-    handlers = [handler] if handler else []
+    handlers = [(cmd.lower(), handler)] if handler else []
     handlers += mentions_handlers
+    args, mentions = match.args, match.mentions
     if not handlers:
         if mentions:
-            print(f"Mentions was not a command")
+            events.debug("Mentions was not a command")
         elif cmd:
-            print(f"Command {cmd} has no handler")
+            events.debug("Command %s has no handler", cmd)
         # else:
-        # print(f"No command specified")
+        # events.debug("No command specified")
 
+        mentions_me = parsed_message.is_mentioned  # only scanned for when no command matched
         if mentions_me: # If no command but is mentioned then call mentions handler
-            print("Switching to mentions handler")
+            events.debug("Switching to mentions handler")
             all_handlers = client._mention_no_cmd_handlers
+            label = "<mention>"
         else:
-            print("Switching to fallback handler")
+            events.debug("Switching to fallback handler")
             all_handlers = client._no_cmd_handlers
+            label = "<text>"
 
         for handler in all_handlers:
             try:
-                await handler(
+                await _run_handler(
+                    label,
+                    handler,
                     client=client,
                     chat_id=chat_id,
                     message_id=reply_id,
@@ -316,12 +360,14 @@ async def webhook(client: WAHABot, request: Request) -> JSONResponse:
                     parsed=parsed_message,
                 )
             except Exception as e:
-                print(f"{handler=} failed with {e}")
+                logger.exception("%s failed with %s", handler, e)
 
-        return JSONResponse({"ok": bool(len(all_handlers)), "amount": len(all_handlers), "mention": mentions_me})
+        return {"ok": bool(len(all_handlers)), "amount": len(all_handlers), "mention": mentions_me}
 
-    for handler in handlers:
-        result = await handler(
+    for label, handler in handlers:
+        result = await _run_handler(
+            label,
+            handler,
             client=client,
             chat_id=chat_id,
             message_id=reply_id,
@@ -331,4 +377,4 @@ async def webhook(client: WAHABot, request: Request) -> JSONResponse:
             raw=evt,
             parsed=parsed_message,
         )
-    return JSONResponse(result or {"ok": True})
+    return result or {"ok": True}